@@ -1,3 +1,4 @@
 /usr/bin/git pull
 pip3 install -r requirements.txt
-python3 greenhouse/Dashboard/dashboard_grafana.py
+# exec makes python PID 1, so that it receives the SIGTERM of docker stop and shuts down in order
+exec python3 greenhouse/Dashboard/dashboard_grafana.py
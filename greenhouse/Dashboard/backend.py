@@ -1,114 +1,593 @@
 import os.path
+from functools import partial
+from time import perf_counter
+from threading import Lock, RLock
 import yaml
 from loguru import logger
-from observer_pattern import Observer, Observable
+from observer_pattern import Observer, Observable, AsyncDispatcher
 from mqtt_subscriber import Subscriber
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta, timezone
+from storage import BufferedWriter, make_storage, to_timestamp
+from payload import configure as configure_devices, parse_datetime, device_from_topic, CATEGORIES, DEFAULT_DEVICE, DROPPED
+from column_store import ColumnStore, epoch_ns
+from rollups import Rollups, DEFAULT_RESOLUTIONS, aggregate
+from pipeline import IngestPipeline
+from wal import WriteAheadLog
+from workers import WorkerPool
+from retention import RetentionTask
 import parsers
+import metrics
+from metrics import Counter, Gauge, Histogram
+from mqtt_subscriber import DECODE_SECONDS, FANOUT_SECONDS
+
+THING_ROWS = Counter('greenhouse_thing_rows_added', 'Rows added to the things in memory')
+THING_FANOUT = FANOUT_SECONDS.labels('thing')
+UPDATE_SECONDS = Histogram('greenhouse_backend_update_seconds', 'Time spent in Backend.update')
+SAVE_SECONDS = Histogram('greenhouse_save_df_seconds', 'Time spent handing rows to the storage')
+DROPPED_TIME_SKEW = DROPPED.labels('time_skew')
+DROPPED_MALFORMED = DROPPED.labels('malformed')
+DUPLICATE_ROWS = Counter('greenhouse_duplicate_rows', 'Rows dropped because their (device, category, element, time) '
+                                                      'was already stored')
+# Sensors graphed by the dashboards when the config has no 'graphs': {element: title}
+DEFAULT_GRAPHS = {'temp_in': 'Inside temperature',
+                  'temp_out': 'Outside temperature',
+                  'MoistureReader': 'Soil moisture'}
+
+
+def read_thing(storage: BufferedWriter, category: str, name: str, start: datetime = None,
+               end: datetime = None) -> pd.DataFrame:
+    frame = storage.read(category, name, start=start, end=end)
+    parser = parsers.get_parser(category)
+    return parser.coerce(name, frame) if parser is not None and len(frame) else frame
 
 
 class Thing(Observable):
-    def __init__(self, data=None):
+    def __init__(self, data=None, loader=None, loaded_from: datetime = None, rollups=DEFAULT_RESOLUTIONS):
         super().__init__()
-        self.data = None
+        self.store = ColumnStore()
+        self.rollups = Rollups(rollups)
+        # Rows older than `loaded_from` are only on disk, `loader(start, end)` reads them back
+        self.loader = loader
+        self.loaded_from = loaded_from
         if data is not None:
             self.init_data(data)
 
+    @property
+    def data(self) -> pd.DataFrame:
+        return self.store.frame()
+
     def init_data(self, data: pd.DataFrame):
-        self.data = data
+        self.store = ColumnStore(capacity=max(1024, len(data)))
+        self.store.append(data)
+        self.rollups.rebuild(data)
+        self.rollups.cover_from(self.loaded_from)
 
     def add_data(self, new_data: pd.DataFrame):
-        self.data = pd.concat((self.data, new_data))
-        self.notify_observers(new_data)
+        self.store.append(new_data)
+        self.rollups.add(new_data)
+        THING_ROWS.inc(len(new_data))
+        with THING_FANOUT.time():
+            self.notify_observers(new_data)
+
+    def range(self, start: datetime = None, end: datetime = None) -> pd.DataFrame:
+        return self.store.range(start, end)
+
+    def latest(self, rows: int = 1) -> pd.DataFrame:
+        return self.store.latest(rows)
+
+    def history(self, start: datetime = None, end: datetime = None) -> pd.DataFrame:
+        recent = self.range(start, end)
+        if self.loader is None or self.loaded_from is None:
+            return recent
+
+        loaded_from = to_timestamp(self.loaded_from)
+        if start is not None and to_timestamp(start) >= loaded_from:
+            return recent
+
+        end = loaded_from if end is None else min(to_timestamp(end), loaded_from)
+        logger.debug(f'Loading history from {start} to {end}...')
+        return pd.concat((self.loader(start, end), recent), ignore_index=True)
+
+    def rollup(self, start: datetime = None, end: datetime = None, max_points: int = 1000) -> pd.DataFrame:
+        # Rollups only cover the rows loaded or retained in memory, older ranges are aggregated from disk on the fly
+        resolution = self.rollups.pick(start, end, max_points)
+        bounds = self.rollups.bounds(start, end)
+        if resolution is not None and resolution.covers(bounds[0]):
+            return resolution.frame(*bounds)
+
+        history = self.history(start, end)
+        if resolution is None or not len(history):
+            return history
+        return aggregate(history, resolution.resolution)
+
+    def trim(self, before: datetime = None, rollup_cutoffs: dict = None) -> tuple:
+        # Rows older than `before` stay reachable through `history` as long as the loader can read them
+        rows = 0
+        if before is not None:
+            rows = self.store.trim(before)
+            if self.loaded_from is None or to_timestamp(before) > to_timestamp(self.loaded_from):
+                self.loaded_from = before
+        buckets = self.rollups.trim(rollup_cutoffs or {})
+        return rows, buckets
+
+
+class LatestValues(Observer):
+    """
+    Last (time, value) of every element per device, updated as soon as a payload is decoded. It does not
+    wait for the payload to be parsed and stored, so the frontends show current values even while the
+    ingest pipeline is behind.
+    """
+
+    def __init__(self):
+        self._devices = {}  # device -> category -> element -> (time, value)
+        self.mutex = Lock()
+
+    def update(self, payload):
+        if payload is None:
+            return
+        time = payload['datetime']
+        with self.mutex:
+            device = self._devices.setdefault(payload['device'], {})
+            for category in CATEGORIES:
+                values = device.setdefault(category, {})
+                for element, value in payload[category].items():
+                    latest = values.get(element)
+                    # Late payloads do not replace newer values
+                    if latest is None or latest[0] <= time:
+                        values[element] = (time, value)
+
+    def get(self, device: str = DEFAULT_DEVICE, category: str = 'sensors') -> dict:
+        with self.mutex:
+            return dict(self._devices.get(device, {}).get(category, {}))
+
+
+class Shard:
+    """
+    Data of one device: its things, storage and write-ahead log, guarded by its own lock so that devices
+    never wait on each other.
+    """
+
+    def __init__(self, device: str, storage: BufferedWriter, hot_window_hours: float = None,
+                 rollups=DEFAULT_RESOLUTIONS, wal_config: dict = None, deduplicate: bool = True):
+        self.device = device
+        self.storage = storage
+        self.rollups = rollups
+        self.deduplicate = deduplicate
+        self.lock = Lock()
+        # Checkpoints run on the shared checkpoint thread and at close, one at a time
+        self._checkpoint_lock = RLock()
+        self.data = self.load_data(storage, hot_window_hours, rollups)
+        self.wal = None
+        if wal_config is not None:
+            self.wal = self.init_wal(wal_config)
+
+    @staticmethod
+    def load_data(storage: BufferedWriter, hot_window_hours: float = None, rollups=DEFAULT_RESOLUTIONS) -> dict:
+        things = storage.things()
+        if not things:
+            logger.warning(f'No data found in "{storage.root}"')
+            return {}
+
+        since = datetime.now(timezone.utc) - timedelta(hours=hot_window_hours) if hot_window_hours else None
+        logger.debug(f'Loading data {f"since {since} " if since else ""}from "{storage.root}"...')
+        data = {}
+
+        for category, name in things:
+            data.setdefault(category, {})[name] = Thing(read_thing(storage, category, name, start=since),
+                                                        loader=partial(read_thing, storage, category, name),
+                                                        loaded_from=since,
+                                                        rollups=rollups)
+
+        logger.debug(f'Data loaded: {", ".join(f"{category} ({len(things)})" for category, things in data.items())}')
+
+        return data
+
+    def store(self, parsed: dict, log: bool = True):
+        with self.lock:
+            if self.deduplicate:
+                parsed = self.unique(parsed)
+                if not parsed:
+                    return
+            if self.wal is not None and log:
+                self.wal.append(parsed)
+            self._store(parsed)
+
+    def unique(self, parsed: dict) -> dict:
+        """
+        Drops the rows whose (category, element, time) is already in memory, or repeated in `parsed`: QoS 1
+        redeliveries and replayed log records then cost no log, storage, notification or database write.
+        The things' sorted time indexes are the recent-key index, bounded by the hot window and retention.
+        """
+        unique = {}
+        duplicates = 0
+        for category, elements in parsed.items():
+            things = self.data.get(category, {})
+            kept = {}
+            for name, frame in elements.items():
+                times = epoch_ns(frame['datetime'])
+                fresh = np.ones(len(times), dtype=bool)
+                if len(times) > 1:
+                    fresh[:] = False
+                    fresh[np.unique(times, return_index=True)[1]] = True
+                thing = things.get(name)
+                if thing is not None:
+                    fresh &= ~thing.store.contains(times)
+
+                if fresh.all():
+                    kept[name] = frame
+                elif fresh.any():
+                    kept[name] = frame[fresh]
+                duplicates += len(fresh) - int(fresh.sum())
+            if kept:
+                unique[category] = kept
+
+        if duplicates:
+            DUPLICATE_ROWS.inc(duplicates)
+            logger.debug(f'Dropped {duplicates} duplicate rows of {self.device}')
+        return unique
+
+    def _store(self, parsed: dict):
+        for category, elements in parsed.items():
+            if category not in self.data:
+                self.data[category] = dict()
+
+            parser = parsers.get_parser(category)
+            for name, element in elements.items():
+                if parser is not None:
+                    element = parser.coerce(name, element)
+                if name not in self.data[category]:
+                    loader = partial(read_thing, self.storage, category, name)
+                    self.data[category][name] = Thing(element, loader=loader, rollups=self.rollups)
+                else:
+                    self.data[category][name].add_data(element)
+
+            self.save_dfs(elements, category)
+
+    def save_dfs(self, dfs: dict, sub_path: str = ''):
+        df: pd.DataFrame
+        for name, df in dfs.items():
+            self.save_df(df, name, sub_path)
+
+    def save_df(self, df: pd.DataFrame, name: str, sub_path: str = ''):
+        logger.debug(f'Appending {len(df)} {name} rows to {self.device}/{sub_path}...')
+        with SAVE_SECONDS.time():
+            self.storage.append(sub_path, name, df)
+
+    def archive_path(self, root: str) -> str:
+        return root if self.device == DEFAULT_DEVICE else os.path.join(root, self.device)
+
+    def expire(self, cutoffs, archive: str) -> dict:
+        # `cutoffs(category)` -> (memory, {resolution: rollup}, disk) cutoff times, see retention.cutoffs
+        stats = {'rows_trimmed': 0, 'buckets_trimmed': 0, 'rows_archived': 0}
+        with self.lock:
+            for category, things in self.data.items():
+                memory, rollups, _ = cutoffs(category)
+                for thing in things.values():
+                    rows, buckets = thing.trim(memory, rollups)
+                    stats['rows_trimmed'] += rows
+                    stats['buckets_trimmed'] += buckets
+
+        for category, name in self.storage.things():
+            disk = cutoffs(category)[2]
+            if disk is not None:
+                stats['rows_archived'] += self.storage.expire(category, name, disk, archive)
+        return stats
+
+    def init_wal(self, config: dict) -> WriteAheadLog:
+        wal = WriteAheadLog(config['path'],
+                            sync_interval=config.get('sync_interval', 0.05),
+                            checkpoint_interval=config.get('checkpoint_interval', 60),
+                            on_checkpoint=self.checkpoint)
+        # Rows that reached the log before the last shutdown. A flush may have written some of them to storage
+        # already: those are skipped, so replaying twice stores nothing twice whatever `deduplicate` says
+        records = list(wal.replay())
+        stored = self.stored_times(records)
+        for parsed in records:
+            parsed = self.unstored(parsed, stored)
+            if parsed:
+                self.store(parsed, log=False)
+        self.checkpoint(wal)
+        return wal
+
+    def stored_times(self, records: list) -> dict:
+        # (category, element) -> epoch ns of the rows in storage from the oldest replayed row of the element on
+        starts = {}
+        for parsed in records:
+            for category, elements in parsed.items():
+                for name, frame in elements.items():
+                    if len(frame):
+                        first = frame['datetime'].min()
+                        starts[(category, name)] = min(first, starts.get((category, name), first))
+
+        existing = set(self.storage.things())
+        stored = {}
+        for (category, name), start in starts.items():
+            frame = self.storage.read(category, name, start=start) if (category, name) in existing else None
+            stored[(category, name)] = epoch_ns(frame['datetime']) if frame is not None and 'datetime' in frame \
+                else np.empty(0, dtype=np.int64)
+        return stored
+
+    @staticmethod
+    def unstored(parsed: dict, stored: dict) -> dict:
+        unstored = {}
+        for category, elements in parsed.items():
+            kept = {}
+            for name, frame in elements.items():
+                fresh = ~np.isin(epoch_ns(frame['datetime']), stored.get((category, name), ()))
+                if fresh.all():
+                    kept[name] = frame
+                elif fresh.any():
+                    kept[name] = frame[fresh]
+            if kept:
+                unstored[category] = kept
+        return unstored
+
+    def checkpoint(self, wal: WriteAheadLog = None):
+        wal = wal or self.wal
+        with self._checkpoint_lock:
+            if wal.closed:
+                return
+            # Under the shard lock every row logged in the rotated segments is also buffered by the storage
+            with self.lock:
+                segments = wal.rotate()
+            # The flush only reaches the OS: the rows must be on disk before the log's copy is removed
+            self.storage.flush()
+            self.storage.sync()
+            wal.remove(segments)
+        logger.debug(f'Checkpoint {self.device}: {len(segments)} log segments flushed to storage')
+
+    def close(self):
+        if self.wal is not None:
+            with self._checkpoint_lock:
+                self.checkpoint()
+                self.wal.close()
+        self.storage.close()
 
 
 class Backend(Observer):
-    def __init__(self, config_path='./config.yaml'):
+    def __init__(self, config_path='./config.yaml', subscribe: bool = True, owns=None, initializer=None):
+        """
+        With `BACKEND.processes` > 0 the subscribing backend only decodes and routes payloads to that many
+        worker processes, each running a non subscribing Backend that `owns` a slice of the devices.
+        `initializer(backend)` is run by every worker on its Backend.
+        """
         logger.debug('Initializing backend...')
+        start = perf_counter()
         with open(config_path, 'r') as file:
             self.config = yaml.safe_load(file)
+        self.device_topic_level = self.config['MQTT_BROKER'].get('device_topic_level')
+        parsers.configure(self.config['BACKEND'].get('dtypes'))
+        configure_devices(self.config['BACKEND'].get('default_device_ids'))
+        # Only the subscribing process serves the endpoint, ingest workers keep their own counters
+        metrics_config = self.config.get('METRICS', {})
+        self.metrics_server = metrics.configure(metrics_config if subscribe else dict(metrics_config, port=None))
+        self.dispatcher = self.init_dispatcher()
+        self.owns = owns or (lambda device: True)
+        self.shards = {}
+        self.shards_lock = Lock()
+        self.workers = None
+        self.close_hooks = []
+        processes = self.config['BACKEND'].get('processes', 0)
+        if subscribe and processes:
+            self.workers = WorkerPool(config_path, processes, initializer=initializer)
+            # The workers do not serve their own metrics, their counters are exported from here
+            workers = self.workers
+            Gauge('greenhouse_ingest_workers', 'Counters of the ingest worker processes',
+                  lambda: {(str(index), stat): value for index, stats in workers.metrics()['per_worker'].items()
+                           for stat, value in stats.items()},
+                  ('worker', 'stat'))
+        else:
+            self.load_shards()
+        self.load_seconds = perf_counter() - start
+        self.retention = None
+        retention_config = self.config.get('RETENTION', {})
+        if self.workers is None and retention_config.get('enabled', False):
+            self.retention = RetentionTask(self, retention_config)
+            self.retention.start()
+        self.latest = LatestValues()
+        self.pipeline = None
         self.subscriber = None
-        self.init_subscriber()
-        self.data = self.load_data(self.config['BACKEND']['data_path'])
-        # self.data = {}
-        self.PARSERS = {'sensors': parsers.CategoryParser,
-                        'actuators': parsers.ActuatorsParser,
-                        'controllers': parsers.ControllersParser}
-        logger.debug('Backend ready.')
+        if subscribe:
+            self.pipeline = self.init_pipeline()
+            self.init_subscriber()
+        self.startup_seconds = perf_counter() - start
+        Gauge('greenhouse_backend_startup_seconds', 'Time the backend took to start', lambda: self.startup_seconds)
+        Gauge('greenhouse_backend_load_seconds', 'Time the backend took to load the stored data',
+              lambda: self.load_seconds)
+        logger.info(f'Backend ready in {self.startup_seconds:.3f}s (data loaded in {self.load_seconds:.3f}s).')
 
-    @staticmethod
-    def load_data(path) -> dict:
-        if not os.path.isdir(path):
-            logger.warning(f'No data directory! "({path})"')
+    @property
+    def data(self) -> dict:
+        if self.workers is not None or not self.owns(DEFAULT_DEVICE):
             return {}
+        return self.shard(DEFAULT_DEVICE).data
 
-        logger.debug(f'Loading data from "{path}"...')
-        categories = os.listdir(path)
-        logger.debug(f'Categories found: {categories}')
+    def load_shards(self):
+        devices_path = self.config['BACKEND'].get('devices_path', './devices')
+        devices = [DEFAULT_DEVICE] + (sorted(os.listdir(devices_path)) if os.path.isdir(devices_path) else [])
+        [self.shard(device) for device in devices if self.owns(device)]
 
-        data = {}
+    def shard(self, device: str) -> Shard:
+        shard = self.shards.get(device)
+        if shard is not None:
+            return shard
 
-        for category in categories:
-            files = os.listdir(os.path.join(path, category))
-            data[category] = {filename.replace('.csv', ''): Thing(pd.read_csv(os.path.join(path, category, filename)))
-                              for
-                              filename in files}
+        with self.shards_lock:
+            if device not in self.shards:
+                self.shards[device] = self.new_shard(device)
+            return self.shards[device]
 
-        logger.debug('Data loaded.')
+    def new_shard(self, device: str) -> Shard:
+        config = dict(self.config['BACKEND'])
+        wal_config = dict(config.get('wal', {}))
+        wal_config.setdefault('path', './wal')
+        if device != DEFAULT_DEVICE:
+            # The default device keeps the single-device layout, the others get their own directories
+            config['data_path'] = os.path.join(config.get('devices_path', './devices'), device)
+            wal_config['path'] = os.path.join(wal_config['path'], device)
 
-        return data
+        logger.info(f'Opening shard "{device}"...')
+        return Shard(device, make_storage(config),
+                     hot_window_hours=config.get('hot_window_hours'),
+                     rollups=config.get('rollups', DEFAULT_RESOLUTIONS),
+                     wal_config=wal_config if wal_config.get('enabled', True) else None,
+                     deduplicate=config.get('deduplicate', True))
 
     def update(self, payload: dict):
-        logger.debug(f'New data received: {payload}')
+        with UPDATE_SECONDS.time():
+            self.store(self.parse(payload))
+
+    def decode(self, message: tuple):
+        topic, payload = message
+        with DECODE_SECONDS.time():
+            payload = Subscriber.parse_payload(payload, device_from_topic(topic, self.device_topic_level))
+        self.latest.update(payload)
+        return payload
+
+    def parse(self, payload: dict):
+        return self.parse_batch([payload])
 
+    def parse_batch(self, payloads: list):
+        batches = {}  # (device, category) -> ([values], [times])
+
+        for payload in payloads:
+            logger.debug(f'New data received: {payload}')
+            time = self.get_time(payload)
+            if time is None:
+                continue
+
+            device = payload.get('device', DEFAULT_DEVICE)
+            for category, values in payload.items():
+                if category in ('datetime', 'device'):
+                    continue
+                categories, times = batches.setdefault((device, category), ([], []))
+                categories.append(values)
+                times.append(time)
+
+        parsed = {}  # device -> category -> element -> DataFrame
+        for (device, category), (categories, times) in batches.items():
+            parser = parsers.get_parser(category)
+            if parser is not None:
+                frames = self.parse_category(parser, category, categories, times)
+                if frames:
+                    parsed.setdefault(device, {})[category] = frames
+
+        return parsed or None
+
+    @staticmethod
+    def parse_category(parser, category: str, categories: list, times: list) -> dict:
+        # Malformed elements are skipped by the parser; should the batch still fail, each payload is parsed
+        # on its own so that only the bad ones are lost
         try:
-            time = datetime.strptime(payload['datetime'], '%Y-%m-%d_%H-%M-%S').replace(tzinfo=timezone.utc)
-        except TypeError as te:
-            logger.error(f'Malformed json: {payload}; {te}')
-            return
+            return parser.parse_batch(categories, times)
+        except Exception as e:
+            logger.warning(f'Parsing {len(categories)} {category} payloads failed, parsing them one by one: {e}')
+
+        frames = {}
+        for values, time in zip(categories, times):
+            try:
+                parsed = parser.parse_batch([values], [time])
+            except Exception as e:
+                DROPPED_MALFORMED.inc()
+                logger.error(f'Malformed {category}: {values}; {e}')
+                continue
+            for element, frame in parsed.items():
+                frames.setdefault(element, []).append(frame)
+        return {element: pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+                for element, parts in frames.items()}
+
+    @staticmethod
+    def get_time(payload: dict):
+        try:
+            time = payload['datetime']
+            if not isinstance(time, datetime):
+                time = parse_datetime(time)
+        except (KeyError, TypeError, ValueError) as e:
+            DROPPED_MALFORMED.inc()
+            logger.error(f'Malformed json: {payload}; {e}')
+            return None
 
         if datetime.now(timezone.utc) - time > timedelta(minutes=30):
+            DROPPED_TIME_SKEW.inc()
             logger.warning(f'Data dropped due to server <-> IoT device time difference')
-            return
+            return None
 
-        payload.pop('datetime')
+        return time
 
-        sensor: str
-        for category, values in payload.items():
-            if category.lower() not in self.data:
-                self.data[category] = dict()
+    def store(self, parsed: dict):
+        if parsed is None:
+            return
 
-            parser = self.PARSERS[category]()
-            elements = parser.parse(category=values, time=time)
+        for device, device_parsed in parsed.items():
+            self.shard(device).store(device_parsed)
 
-            for name, element in elements.items():
-                if name not in self.data[category]:
-                    self.data[category][name] = Thing(element)
-                else:
-                    self.data[category][name].add_data(element)
+    def init_dispatcher(self):
+        config = self.config['BACKEND'].get('observers', {})
+        if not config.get('async', False):
+            return None
 
-            self.save_dfs(self.data[category], category)
+        dispatcher = AsyncDispatcher(config.get('workers', 4))
+        Observable.default_dispatcher = dispatcher
+        Gauge('greenhouse_observer_pending', 'Notifications waiting for each kind of observer',
+              lambda: self.observer_lag('pending', sum), ('observer',))
+        Gauge('greenhouse_observer_lag_seconds', 'Age of the oldest notification waiting for each kind of observer',
+              lambda: self.observer_lag('oldest', max), ('observer',))
+        return dispatcher
 
-    def save_dfs(self, dfs: dict, sub_path: str = ''):
-        thing: Thing
-        for name, thing in dfs.items():
-            self.save_df(thing, name, sub_path)
+    def observer_lag(self, stat: str, combine) -> dict:
+        lags = {}
+        for observer, lag in self.dispatcher.lag().items():
+            lags.setdefault((type(observer).__name__,), []).append(lag[stat])
+        return {key: combine(values) for key, values in lags.items()}
 
-    def save_df(self, thing: Thing, name: str, sub_path: str = ''):
-        root = self.config['BACKEND']['data_path']
-        relative_path = os.path.join(root, sub_path)
+    def init_pipeline(self):
+        config = self.config['BACKEND'].get('pipeline', {})
+        if not config.get('enabled', True):
+            return None
 
-        if not os.path.exists(root):
-            os.mkdir(root)
+        if self.workers is not None:
+            stages = [('decode', self.decode),
+                      ('route', self.workers.route, True)]
+        else:
+            stages = [('decode', self.decode),
+                      ('parse', self.parse_batch, True),
+                      ('store', self.store)]
+        pipeline = IngestPipeline(stages,
+                                  maxsize=config.get('maxsize', 1000),
+                                  policy=config.get('policy', 'block'),
+                                  workers=config.get('workers', 1))
+        Gauge('greenhouse_pipeline', 'Ingest pipeline queue statistics',
+              lambda: {(stage, stat): value for stage, stats in pipeline.metrics().items() for stat, value in stats.items()},
+              ('stage', 'stat'))
+        return pipeline
 
-        if not os.path.exists(relative_path):
-            os.mkdir(relative_path)
+    def stop_subscriber(self):
+        if self.subscriber is not None:
+            self.subscriber.stop()
+            self.subscriber = None
 
-        filepath = os.path.join(root, sub_path, f'{name}.csv')
-        logger.debug(f'Saving {name} DataFrame to {filepath}...')
-        thing.data.to_csv(filepath, columns=thing.data.columns, index=False)
-        logger.debug(f'Saved.')
+    def close(self):
+        # Inputs are stopped before the queues they feed are drained, storage and database hooks go last
+        self.stop_subscriber()
+        if self.retention is not None:
+            self.retention.close()
+        if self.pipeline is not None:
+            self.pipeline.close()
+        if self.workers is not None:
+            self.workers.close()
+        if self.dispatcher is not None:
+            # Observers get the notifications already queued, later ones are delivered inline
+            self.dispatcher.close(self.config['BACKEND'].get('observers', {}).get('close_timeout', 30))
+            if Observable.default_dispatcher is self.dispatcher:
+                Observable.default_dispatcher = None
+        logger.info('Flushing backend storage...')
+        [shard.close() for shard in self.shards.values()]
+        [hook() for hook in self.close_hooks]
+        logger.success('Backend storage flushed.')
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
 
     def init_subscriber(self):
         logger.info(f'Setting up subscriber...')
@@ -119,8 +598,13 @@ class Backend(Observer):
         topic = config['topic']
         mqtt_id = config['id']
 
-        self.subscriber = Subscriber(broker, port, topic, qos, mqtt_id)
+        self.subscriber = Subscriber(broker, port, topic, qos, mqtt_id, self.device_topic_level)
         self.subscriber.connect()
         self.subscriber.start()
-        self.subscriber.add_observer(self)
+        if self.pipeline is not None:
+            # The decode stage updates the latest values
+            self.subscriber.pipeline = self.pipeline
+        else:
+            self.subscriber.add_observer(self.latest)
+            self.subscriber.add_observer(self.workers if self.workers is not None else self)
         logger.success('Subscriber ready.')
@@ -0,0 +1,186 @@
+import argparse
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from time import monotonic
+import pandas as pd
+import yaml
+from loguru import logger
+import parsers
+from db_writer import BatchWriter, make_engine
+from parsers import PARSERS
+from storage import SegmentWriter
+
+# Series that DBUpdater writes under another name
+TABLES = {('sensors', 'MoistureReader'): ('data', 'moisture')}
+
+
+def destination(category: str, name: str) -> tuple:
+    # Sensors go to the "data" schema like DBUpdater's tables, the other categories to a schema of their own
+    return TABLES.get((category, name), ('data' if category == 'sensors' else category, name))
+
+
+def read_chunks(filepath: str, offset: int, chunk_rows: int):
+    """
+    Yields (end offset, frame) for every `chunk_rows` lines after byte `offset` (0 for the first row).
+    Only complete lines are read, so a row the backend is still appending waits for the next run.
+    """
+    with open(filepath, 'rb') as file:
+        header = file.readline()
+        if not header.endswith(b'\n'):
+            return
+        file.seek(max(offset, len(header)))
+        while True:
+            start = file.tell()
+            lines = []
+            for _ in range(chunk_rows):
+                line = file.readline()
+                if not line.endswith(b'\n'):
+                    break
+                lines.append(line)
+            if not lines:
+                return
+            yield start + sum(map(len, lines)), pd.read_csv(BytesIO(header + b''.join(lines)))
+            if len(lines) < chunk_rows:
+                return
+
+
+class Checkpoints:
+    """Byte offset and row count loaded so far per CSV file, in a JSON file replaced atomically on every change."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.files = {}
+        if os.path.exists(path):
+            with open(path) as file:
+                self.files = json.load(file)
+
+    def offset(self, key: str, size: int) -> int:
+        offset = self.files.get(key, {}).get('offset', 0)
+        if offset > size:
+            # Rewritten since, e.g. by the retention: it is loaded again and deduplication skips the known rows
+            logger.warning(f'{key} is smaller than its checkpoint, loading it from the start')
+            self.files.pop(key)
+            return 0
+        return offset
+
+    def save(self, key: str, offset: int, rows: int):
+        entry = self.files.setdefault(key, {'offset': 0, 'rows': 0})
+        entry['offset'] = offset
+        entry['rows'] += rows
+        with open(f'{self.path}.tmp', 'w') as file:
+            json.dump(self.files, file, indent=2)
+        os.replace(f'{self.path}.tmp', self.path)
+
+
+class Backfill:
+    """
+    Streams every <data_path>/<category>/<name>.csv into the database table DBUpdater feeds with the same
+    series. Chunks of `chunk_rows` rows are written by `connections` threads, each with its own pooled
+    connection, through BatchWriter.insert: COPY on PostgreSQL, multi-row INSERT elsewhere. At most two
+    chunks per connection are in memory at a time. The checkpoint only moves past a chunk once it and
+    every chunk before it in its file are committed, so an interrupted run resumes where it stopped; with
+    `key`, rows written again after a crash are skipped by the unique index.
+    """
+
+    def __init__(self, data_path: str, db_config: dict, checkpoint_path: str, connections: int = 4,
+                 chunk_rows: int = 50_000, key: tuple = ('datetime',)):
+        self.data_path = data_path
+        self.chunk_rows = chunk_rows
+        self.connections = connections
+        self.key = key
+        self.checkpoints = Checkpoints(checkpoint_path)
+        # One more connection than threads for the first chunk of each file, written inline
+        engine = make_engine(dict(db_config, pool_size=connections + 1, max_overflow=0))
+        self.writer = BatchWriter(engine, batch_rows=chunk_rows, retries=db_config.get('retries', 3))
+        self.executor = ThreadPoolExecutor(connections, thread_name_prefix='backfill')
+        self._in_flight = deque()  # (checkpoint key, end offset, rows, future) in submission order
+        self._schemas = set()
+        self.rows = 0
+
+    def run(self, categories: list = None) -> int:
+        start = monotonic()
+        try:
+            for category, name in sorted(SegmentWriter(self.data_path).things()):
+                if not categories or category in categories:
+                    self.load(category, name)
+            self._wait(0)
+        finally:
+            self.executor.shutdown()
+            self.writer.close()
+        elapsed = monotonic() - start
+        logger.success(f'Backfilled {self.rows} rows in {elapsed:.1f}s '
+                       f'({self.rows / elapsed if elapsed else 0:.0f} rows/s).')
+        return self.rows
+
+    def load(self, category: str, name: str):
+        filepath = os.path.join(self.data_path, category, f'{name}.csv')
+        key = os.path.relpath(filepath, self.data_path)
+        schema, table = destination(category, name)
+        offset = self.checkpoints.offset(key, os.path.getsize(filepath))
+        logger.info(f'Loading {filepath} into {schema}.{table} from byte {offset}...')
+        self._ensure_schema(schema)
+
+        parser = PARSERS.get(category)
+        for index, (end, chunk) in enumerate(read_chunks(filepath, offset, self.chunk_rows)):
+            chunk = parser.coerce(name, chunk) if parser is not None else chunk
+            if index == 0:
+                # Creates the table and its unique index before several connections write to it
+                self._check(self.writer.insert(schema, table, chunk, self.key), table)
+                self._committed(key, end, len(chunk))
+                continue
+            self._wait(2 * self.connections - 1)
+            future = self.executor.submit(self.writer.insert, schema, table, chunk, self.key)
+            self._in_flight.append((key, end, len(chunk), future))
+
+    def _wait(self, limit: int):
+        # Checkpoints the oldest chunks as they commit until at most `limit` are in flight
+        while self._in_flight and (len(self._in_flight) > limit or self._in_flight[0][3].done()):
+            key, end, rows, future = self._in_flight.popleft()
+            self._check(future.result(), key)
+            self._committed(key, end, rows)
+
+    def _committed(self, key: str, end: int, rows: int):
+        self.checkpoints.save(key, end, rows)
+        self.rows += rows
+
+    def _check(self, written: bool, what: str):
+        if not written:
+            # The chunks already submitted are still written, the checkpoint stays before the failed one
+            for _, _, _, future in self._in_flight:
+                future.cancel()
+            raise RuntimeError(f'Cannot write {what}, run the backfill again to resume from the last checkpoint')
+
+    def _ensure_schema(self, schema: str):
+        if self.writer.dialect != 'postgresql' or schema in self._schemas:
+            return
+        with self.writer.engine.begin() as conn:
+            conn.exec_driver_sql(f'CREATE SCHEMA IF NOT EXISTS "{schema}"')
+        self._schemas.add(schema)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load the history stored in <data_path>/<category>/<name>.csv '
+                                                 'into the database, resuming from the last checkpoint.')
+    parser.add_argument('config', nargs='?', default=os.environ.get('config_file', './config.yaml'))
+    parser.add_argument('--data-path', help='defaults to BACKEND.data_path')
+    parser.add_argument('--categories', nargs='+', help='only these categories, e.g. sensors')
+    parser.add_argument('--connections', type=int, default=4)
+    parser.add_argument('--chunk-rows', type=int, default=50_000)
+    parser.add_argument('--checkpoint', default='./backfill.json')
+    args = parser.parse_args()
+
+    with open(args.config) as file:
+        config = yaml.safe_load(file)
+    parsers.configure(config['BACKEND'].get('dtypes'))
+    key = ('datetime',) if config['DATABASE'].get('deduplicate', True) else None
+    backfill = Backfill(args.data_path or config['BACKEND'].get('data_path', './data'), config['DATABASE'],
+                        args.checkpoint, args.connections, args.chunk_rows, key)
+    try:
+        backfill.run(args.categories)
+    except RuntimeError as e:
+        logger.error(str(e))
+        sys.exit(1)
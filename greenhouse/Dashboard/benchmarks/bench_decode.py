@@ -0,0 +1,64 @@
+import argparse
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from payload import decode, loads  # noqa: E402
+
+
+def legacy_decode(message) -> dict:
+    # Subscriber.parse_payload and the Backend.update time parsing before the precompiled decoder
+    payload = json.loads(message)
+    assert set(payload.keys()) == {'datetime', 'sensors', 'actuators', 'controllers'}
+    assert isinstance(payload['datetime'], str) or isinstance(payload['timestamp'], float)
+    assert isinstance(payload['sensors'], dict)
+    assert isinstance(payload['actuators'], dict)
+    assert isinstance(payload['controllers'], dict)
+
+    parsed = {'datetime': payload['datetime'],
+              'sensors': payload['sensors'],
+              'actuators': payload['actuators'],
+              'controllers': payload['controllers']}
+    parsed['datetime'] = datetime.strptime(parsed['datetime'], '%Y-%m-%d_%H-%M-%S').replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def messages(count: int) -> list:
+    start = datetime(2021, 11, 1, tzinfo=timezone.utc)
+    return [json.dumps({'datetime': (start + timedelta(seconds=5 * i)).strftime('%Y-%m-%d_%H-%M-%S'),
+                        'sensors': {'LightReader': random.randint(0, 100),
+                                    'MoistureReader': random.randint(0, 100)},
+                        'actuators': {'LED': {'available': True, 'info': '0%'},
+                                      'Pump': {'available': False, 'info': ''}},
+                        'controllers': {'MoistureController': {'enabled': True, 'busy': False},
+                                        'LightController': {'enabled': True, 'busy': True}}}).encode()
+            for i in range(count)]
+
+
+def rate(function, batch: list) -> float:
+    start = perf_counter()
+    for message in batch:
+        function(message)
+    return len(batch) / (perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Payload decoding throughput, before and after.')
+    parser.add_argument('-n', '--messages', type=int, default=100_000)
+    args = parser.parse_args()
+
+    batch = messages(args.messages)
+    before = rate(legacy_decode, batch)
+    after = rate(decode, batch)
+    print(f'JSON backend: {loads.__module__}')
+    print(f'before: {before:>12,.0f} msg/s')
+    print(f'after:  {after:>12,.0f} msg/s ({after / before:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
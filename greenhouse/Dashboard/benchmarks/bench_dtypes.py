@@ -0,0 +1,58 @@
+import argparse
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from column_store import ColumnStore  # noqa: E402
+from parsers import PARSERS  # noqa: E402
+
+
+def samples(category: str, rows: int) -> dict:
+    times = pd.date_range('2021-11-01', periods=rows, freq='5s', tz='UTC')
+    if category == 'sensors':
+        return {'datetime': times, 'value': np.random.randint(0, 100, rows)}
+    return {'datetime': times, **{field: np.random.randint(0, 2, rows).astype(bool)
+                                  for field in PARSERS[category].FIELDS}}
+
+
+def legacy(columns: dict) -> pd.DataFrame:
+    # What get_df and the CSV/concat round trips used to leave in memory: Python datetimes and values
+    return pd.DataFrame({column: np.array(values.to_pydatetime() if column == 'datetime' else values.tolist(),
+                                          dtype=object)
+                         for column, values in columns.items()})
+
+
+def inferred(columns: dict) -> pd.DataFrame:
+    # Default inference on the same values: datetime64[ns, UTC], int64 and bool
+    return pd.DataFrame({column: values for column, values in columns.items()})
+
+
+def megabytes(frame: pd.DataFrame, rows: int) -> float:
+    return frame.memory_usage(index=False, deep=True).sum() / rows * 1_000_000 / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory per million samples: legacy objects vs compact schema.')
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    print(f'{"category":>12} {"legacy (MB)":>12} {"inferred (MB)":>14} {"compact (MB)":>13} '
+          f'{"store (MB)":>11} {"reduction":>10}')
+    for category, category_parser in PARSERS.items():
+        columns = samples(category, args.rows)
+        compact = category_parser.frame('element', {column: values for column, values in columns.items()})
+        store = ColumnStore(capacity=args.rows)
+        store.append(compact)
+
+        legacy_mb = megabytes(legacy(columns), args.rows)
+        compact_mb = megabytes(compact, args.rows)
+        print(f'{category:>12} {legacy_mb:>12.1f} {megabytes(inferred(columns), args.rows):>14.1f} '
+              f'{compact_mb:>13.1f} {store.nbytes / args.rows * 1_000_000 / 2 ** 20:>11.1f} '
+              f'{1 - compact_mb / legacy_mb:>10.0%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+from collections import deque
+from time import perf_counter, process_time, thread_time, sleep
+import numpy as np
+import yaml
+from loguru import logger
+from paho.mqtt.client import MQTTMessage
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend import Backend, Thing  # noqa: E402
+from dashboard_grafana import DBUpdater, init_db_writer  # noqa: E402
+from dummy_data_generator import Generator  # noqa: E402
+from mqtt_subscriber import Subscriber  # noqa: E402
+
+TOPIC = 'greenhouse/{device}/telemetry'
+
+
+class FakeTransport:
+    """
+    Stands in for the broker and paho's network loop: `deliver` builds the MQTTMessage paho would and hands
+    it to the client's `on_message` callback on the calling thread, so nothing but the socket is skipped.
+    """
+
+    def __init__(self, subscriber: Subscriber):
+        self.subscriber = subscriber
+
+    def deliver(self, topic: str, payload: bytes, qos: int = 0):
+        message = MQTTMessage(topic=topic.encode())
+        message.payload = payload
+        message.qos = qos
+        self.subscriber.client.on_message(self.subscriber.client, None, message)
+
+
+class StageTimer:
+    """CPU time of the calling thread spent in wrapped callables; nested stages are subtracted from their parent."""
+
+    def __init__(self):
+        self.seconds = {}
+        self._local = threading.local()
+
+    def wrap(self, name: str, function):
+        def timed(*args, **kwargs):
+            # Pipeline stages run on their own threads, each keeps its own stack
+            stack = self._local.__dict__.setdefault('stack', [])
+            start = thread_time()
+            stack.append(0.0)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = thread_time() - start
+                nested = stack.pop()
+                self.seconds[name] = self.seconds.get(name, 0.0) + elapsed - nested
+                if stack:
+                    stack[-1] += elapsed
+        return timed
+
+
+class Completions:
+    """
+    Times at which the pipeline's store stage finishes the messages, in delivery order. With one worker
+    per stage the messages go through every stage in order, so the n-th message completes with the
+    store call that brings the count of stored messages to n. Every generated message is valid, none
+    stops before the store stage.
+    """
+
+    def __init__(self, messages: int):
+        self.times = np.full(messages, np.nan)
+        self.done = 0
+        self._batches = deque()  # messages in each parsed batch not stored yet
+
+    def wrap_parse(self, function):
+        def parse(payloads):
+            self._batches.append(len(payloads))
+            return function(payloads)
+        return parse
+
+    def wrap_store(self, function):
+        def store(parsed):
+            try:
+                return function(parsed)
+            finally:
+                count = self._batches.popleft()
+                self.times[self.done:self.done + count] = perf_counter()
+                self.done += count
+        return store
+
+
+def rss_bytes() -> int:
+    with open('/proc/self/statm') as file:
+        return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def make_config(directory: str, devices: int, pipeline: bool = False) -> str:
+    config = {'MQTT_BROKER': {'address': 'localhost', 'port': 1883, 'qos': 0, 'id': 'bench',
+                              'topic': TOPIC.format(device='+'), 'device_topic_level': 1},
+              'BACKEND': {'data_path': os.path.join(directory, 'data'),
+                          'devices_path': os.path.join(directory, 'devices'),
+                          'flush_rows': 1000,
+                          'wal': {'path': os.path.join(directory, 'wal')},
+                          'pipeline': {'enabled': pipeline}},
+              'DATABASE': {'url': f'sqlite:///{os.path.join(directory, "bench.sqlite")}',
+                           'batch_rows': 500}}
+    path = os.path.join(directory, 'config.yaml')
+    with open(path, 'w') as file:
+        yaml.safe_dump(config, file)
+    return path
+
+
+def run(devices: int, rate: float, messages: int, pipeline: bool = False) -> dict:
+    """
+    Without `pipeline`, every message is stored on the delivering thread and its latency ends when
+    `deliver` returns. With it, messages go through the decode -> parse -> store worker threads and
+    their latency ends when the store stage is done with them.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = make_config(directory, devices, pipeline)
+        backend = Backend(config_path, subscribe=False)
+        writer = init_db_writer(backend.config['DATABASE'])
+        timer = StageTimer()
+
+        names = [f'device-{index}' for index in range(devices)]
+        updaters = []
+        for name in names:
+            sensors = backend.shard(name).data.setdefault('sensors', {})
+            for element in ('LightReader', 'MoistureReader'):
+                updaters.append(DBUpdater('data', element, sensors.setdefault(element, Thing()), writer))
+        for updater in updaters:
+            updater.update = timer.wrap('db', updater.update)
+        writer.flush = timer.wrap('db_flush', writer.flush)
+
+        subscriber = Subscriber('localhost', 1883, TOPIC.format(device='+'), 0, 'bench', device_topic_level=1)
+        completions = Completions(messages)
+        if pipeline:
+            # Backend(subscribe=False) has no pipeline: it is built here on the wrapped stages
+            backend.decode = timer.wrap('decode', backend.decode)
+            backend.parse_batch = completions.wrap_parse(timer.wrap('parse', backend.parse_batch))
+            backend.store = completions.wrap_store(timer.wrap('store', backend.store))
+            backend.pipeline = backend.init_pipeline()
+            subscriber.pipeline = backend.pipeline
+        else:
+            subscriber.parse_payload = timer.wrap('decode', subscriber.parse_payload)
+            backend.parse = timer.wrap('parse', backend.parse)
+            backend.store = timer.wrap('store', backend.store)
+            subscriber.add_observer(backend)
+        transport = FakeTransport(subscriber)
+
+        # Payloads are generated up front so that the generator's cost is not measured
+        payloads = [(TOPIC.format(device=names[index % devices]), Generator.new_payload().encode())
+                    for index in range(messages)]
+        scheduled_times = np.empty(messages)
+        latencies = np.empty(messages)
+        rss_start = rss_bytes()
+        cpu_start, thread_start = process_time(), thread_time()
+        start = perf_counter()
+
+        for index, (topic, payload) in enumerate(payloads):
+            # Latency counts from the scheduled send time, so falling behind the rate shows up as queueing
+            scheduled = start + index / rate if rate else perf_counter()
+            if rate:
+                wait = scheduled - perf_counter()
+                if wait > 0:
+                    sleep(wait)
+            transport.deliver(topic, payload)
+            scheduled_times[index] = scheduled
+            latencies[index] = perf_counter() - scheduled
+
+        if pipeline:
+            backend.pipeline.drain()
+            latencies = completions.times - scheduled_times
+        writer.flush()
+        elapsed = perf_counter() - start
+        cpu, main_thread = process_time() - cpu_start, thread_time() - thread_start
+        rss_end = rss_bytes()
+        stats = writer.stats()
+        writer.close()
+        backend.close()
+
+    stages = dict(timer.seconds)
+    # The pipeline's stages run on threads of their own, outside of the main thread's time
+    stages['background'] = max(0.0, cpu - main_thread - (sum(stages.values()) if pipeline else 0.0))
+    return {'devices': devices,
+            'rate': rate,
+            'pipeline': pipeline,
+            'messages': messages,
+            'seconds': elapsed,
+            'throughput': messages / elapsed,
+            'latency_ms': {'p50': float(np.nanpercentile(latencies, 50) * 1000),
+                           'p99': float(np.nanpercentile(latencies, 99) * 1000),
+                           'max': float(np.nanmax(latencies) * 1000)},
+            'rss_bytes': {'start': rss_start, 'end': rss_end, 'growth': rss_end - rss_start,
+                          'peak': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024},
+            'cpu_seconds': {'total': cpu, 'stages': stages},
+            'db_rows': stats['rows']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline Subscriber -> Backend -> DBUpdater ingest benchmark '
+                                                 'with a fake MQTT transport and SQLite.')
+    parser.add_argument('--devices', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--rates', type=float, nargs='+', default=[0],
+                        help='messages per second over all devices, 0 for as fast as possible')
+    parser.add_argument('--messages', type=int, default=2_000)
+    parser.add_argument('--pipeline', action='store_true',
+                        help='store through the ingest pipeline threads, latency up to the end of the store stage')
+    parser.add_argument('--output', help='write the results as JSON to this file ("-" for stdout)')
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+
+    results = []
+    print(f'{"devices":>8} {"rate":>8} {"msg/s":>10} {"p50 (ms)":>10} {"p99 (ms)":>10} {"RSS +MB":>9}  CPU by stage (s)',
+          file=sys.stderr)
+    for devices in args.devices:
+        for rate in args.rates:
+            result = run(devices, rate, args.messages, args.pipeline)
+            results.append(result)
+            stages = ', '.join(f'{name} {seconds:.2f}' for name, seconds in result['cpu_seconds']['stages'].items())
+            print(f'{devices:>8} {rate or "max":>8} {result["throughput"]:>10,.0f} '
+                  f'{result["latency_ms"]["p50"]:>10.3f} {result["latency_ms"]["p99"]:>10.3f} '
+                  f'{result["rss_bytes"]["growth"] / 2 ** 20:>9.1f}  {stages}', file=sys.stderr)
+
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2)
+    elif args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
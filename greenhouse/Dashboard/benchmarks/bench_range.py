@@ -0,0 +1,53 @@
+import argparse
+import os
+import sys
+from time import perf_counter
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from column_store import ColumnStore  # noqa: E402
+
+
+def history(rows: int) -> pd.DataFrame:
+    times = pd.date_range('2021-11-01', periods=rows, freq='5s', tz='UTC')
+    # Loaded from CSV the datetimes are strings
+    return pd.DataFrame({'datetime': times.astype(str), 'value': np.random.randint(0, 100, rows)})
+
+
+def mask_query(frame: pd.DataFrame, start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+    times = pd.to_datetime(frame['datetime'], utc=True)
+    return frame[(times >= start) & (times < end)]
+
+
+def timed(function, repeat: int) -> float:
+    start = perf_counter()
+    for _ in range(repeat):
+        function()
+    return (perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time window query latency: boolean mask vs sorted index.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument('--window', type=int, default=720, help='rows in the queried window')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f'{"rows":>10} {"mask (ms)":>12} {"range (ms)":>12} {"latest (ms)":>12}')
+    for size in args.sizes:
+        frame = history(size)
+        store = ColumnStore(capacity=size)
+        store.append(frame)
+        end = pd.Timestamp(frame['datetime'].iloc[-1])
+        start = end - pd.Timedelta(seconds=5 * args.window)
+
+        mask = timed(lambda: mask_query(frame, start, end), args.repeat)
+        indexed = timed(lambda: store.range(start, end), args.repeat)
+        latest = timed(lambda: store.latest(args.window), args.repeat)
+        print(f'{size:>10,} {mask * 1000:>12.3f} {indexed * 1000:>12.3f} {latest * 1000:>12.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from threading import Lock
+from storage import to_timestamp
+
+
+def epoch_ns(times) -> np.ndarray:
+    return pd.to_datetime(pd.Series(times), utc=True).to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+
+class ColumnStore:
+    """
+    Growable column store: one preallocated NumPy array per column whose capacity doubles when full,
+    so appends are amortized O(1). The DataFrame returned by `frame` is built on demand and cached
+    until the next append.
+
+    Rows are kept sorted by `time_column`, stored only as the int64 epoch (ns) index that `range` and
+    `latest` binary search and returned as datetime64[ns, UTC]. Late rows are merged into the tail they
+    belong to: only the rows newer than them are moved.
+    """
+
+    def __init__(self, capacity: int = 1024, time_column: str = 'datetime'):
+        self.time_column = time_column
+        self._columns = {}  # column name -> np.ndarray of length `self._capacity`
+        self._index = np.empty(capacity, dtype=np.int64)
+        self._size = 0
+        self._capacity = capacity
+        self._frame = None
+        self.mutex = Lock()
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def columns(self) -> list:
+        return [self.time_column, *self._columns]
+
+    @property
+    def nbytes(self) -> int:
+        return self._index.nbytes + sum(array.nbytes for array in self._columns.values())
+
+    def append(self, frame: pd.DataFrame):
+        rows = len(frame)
+        if rows == 0:
+            return
+
+        times = epoch_ns(frame[self.time_column])
+        if np.any(times[1:] < times[:-1]):
+            order = np.argsort(times, kind='stable')
+            frame, times = frame.iloc[order], times[order]
+
+        with self.mutex:
+            self._reserve(self._size + rows)
+            size = self._size
+            if size == 0 or times[0] >= self._index[size - 1]:
+                first, positions = size, slice(0, rows)
+            else:
+                first = int(np.searchsorted(self._index[:size], times[0], side='right'))
+                positions = np.searchsorted(self._index[first:size], times, side='right') + np.arange(rows)
+
+            self._place(self._index, times, first, positions)
+            for column in frame.columns:
+                if column == self.time_column:
+                    continue
+                values = np.asarray(frame[column].to_numpy())
+                if column not in self._columns:
+                    self._columns[column] = np.empty(self._capacity, dtype=object if size else values.dtype)
+                self._place(self._cast(column, values), values, first, positions)
+
+            for column in self._columns.keys() - set(frame.columns) - {self.time_column}:
+                values = np.full(rows, None, dtype=object)
+                self._place(self._cast(column, values), values, first, positions)
+
+            self._size = size + rows
+            self._frame = None
+
+    def trim(self, before: datetime) -> int:
+        # Rows older than `before` are dropped by moving the kept ones to the front of the same arrays;
+        # the arrays are only reallocated when less than a quarter of their capacity is still used.
+        with self.mutex:
+            cut = int(np.searchsorted(self._index[:self._size], to_timestamp(before).value, side='left'))
+            if cut == 0:
+                return 0
+
+            kept = self._size - cut
+            capacity = self._capacity
+            while capacity > 1024 and kept * 4 < capacity:
+                capacity //= 2
+            for column, array in self._columns.items():
+                self._columns[column] = self._shift(array, cut, kept, capacity)
+            self._index = self._shift(self._index, cut, kept, capacity)
+            self._capacity = capacity
+            self._size = kept
+            self._frame = None
+            return cut
+
+    def contains(self, times: np.ndarray) -> np.ndarray:
+        # Whether each int64 epoch (ns) is already stored, by binary search on the index
+        with self.mutex:
+            index = self._index[:self._size]
+            if not self._size:
+                return np.zeros(len(times), dtype=bool)
+            positions = np.minimum(np.searchsorted(index, times), self._size - 1)
+            return index[positions] == times
+
+    def frame(self) -> pd.DataFrame:
+        with self.mutex:
+            if self._frame is None:
+                self._frame = self._build(0, self._size)
+            return self._frame
+
+    def range(self, start: datetime = None, end: datetime = None) -> pd.DataFrame:
+        with self.mutex:
+            index = self._index[:self._size]
+            first = int(np.searchsorted(index, to_timestamp(start).value, side='left')) if start is not None else 0
+            last = int(np.searchsorted(index, to_timestamp(end).value, side='left')) if end is not None else self._size
+            return self._slice(first, max(first, last))
+
+    def latest(self, rows: int = 1) -> pd.DataFrame:
+        with self.mutex:
+            return self._slice(max(0, self._size - rows), self._size)
+
+    def _slice(self, first: int, last: int) -> pd.DataFrame:
+        # A slice of the cached frame is a view; otherwise only the selected rows are materialized
+        if self._frame is not None:
+            return self._frame.iloc[first:last]
+        return self._build(first, last)
+
+    def _build(self, first: int, last: int) -> pd.DataFrame:
+        times = pd.to_datetime(self._index[first:last], unit='ns', utc=True)
+        return pd.DataFrame({self.time_column: times,
+                             **{column: array[first:last] for column, array in self._columns.items()}})
+
+    def _place(self, array: np.ndarray, values: np.ndarray, first: int, positions):
+        if isinstance(positions, slice):
+            array[first:first + len(values)] = values
+            return
+
+        region = array[first:self._size + len(values)]
+        moved = np.ones(len(region), dtype=bool)
+        moved[positions] = False
+        region[moved] = array[first:self._size].copy()
+        region[positions] = values
+
+    def _cast(self, column: str, values: np.ndarray) -> np.ndarray:
+        array = self._columns[column]
+        if values.dtype != array.dtype and not np.can_cast(values.dtype, array.dtype, casting='safe'):
+            try:
+                dtype = np.result_type(array.dtype, values.dtype)
+            except TypeError:
+                dtype = np.dtype(object)
+            array = self._columns[column] = array.astype(dtype)
+        return array
+
+    def _reserve(self, required: int):
+        if required <= self._capacity:
+            return
+
+        capacity = self._capacity
+        while capacity < required:
+            capacity *= 2
+
+        for column, array in self._columns.items():
+            self._columns[column] = self._grow(array, capacity)
+        self._index = self._grow(self._index, capacity)
+        self._capacity = capacity
+
+    def _shift(self, array: np.ndarray, cut: int, kept: int, capacity: int) -> np.ndarray:
+        if capacity == len(array):
+            array[:kept] = array[cut:cut + kept]
+            if array.dtype == object:
+                array[kept:cut + kept] = None  # Release the references held by the dropped rows
+            return array
+        shrunk = np.empty(capacity, dtype=array.dtype)
+        shrunk[:kept] = array[cut:cut + kept]
+        return shrunk
+
+    def _grow(self, array: np.ndarray, capacity: int) -> np.ndarray:
+        grown = np.empty(capacity, dtype=array.dtype)
+        grown[:self._size] = array[:self._size]
+        return grown
@@ -1,93 +1,71 @@
+import atexit
 import os.path
+import sys
+import threading
+import time
 import yaml
 from loguru import logger
-from observer_pattern import Observer
-from mqtt_subscriber import Subscriber
-import sys
 import streamlit as st
 import pandas as pd
-from datetime import datetime, timedelta
-import parsers
+from backend import Backend, Thing, DEFAULT_GRAPHS
+from observer_pattern import Observer
 
 log_format = '<light-black>{time:YYYY-MM-DD HH:mm:ss.SSS}</light-black>' \
              ' <level>{name}.{function}@{line} | {level}: {message}</level>'
 
 
 class Dashboard(Observer):
+    """
+    The state shared by every Streamlit session: one Backend with its MQTT subscriber, created once per
+    server process through `get_dashboard`. Sessions block in `wait` until one of the graphed things
+    receives rows, then read only the rows after their own cursor.
+    """
+
     def __init__(self, config_path='./config.yaml'):
         with open(config_path, 'r') as file:
             self.config = yaml.safe_load(file)
         self.init_logger(self.config['LOGGER']['path'])
-        self.subscriber = None
-        self.init_subscriber()
-        self.data = self.load_data(self.config['BACKEND']['data_path'])
-        # self.data = {}
-        st.title(self.config['FRONTEND']['title'])
-        self.PARSERS = {'sensors': parsers.CategoryParser,
-                        'actuators': parsers.ActuatorsParser,
-                        'controllers': parsers.ControllersParser}
-
-    @staticmethod
-    def load_data(path) -> dict:
-        logger.debug(f'Loading data from "{path}"...')
-        categories = os.listdir(path)
-        logger.debug(f'Categories found: {categories}')
-
-        data = {}
-
-        for category in categories:
-            files = os.listdir(os.path.join(path, category))
-            data[category] = {filename.replace('.csv', ''): pd.read_csv(os.path.join(path, category, filename)) for
-                              filename in files}
-
-        logger.debug('Data loaded.')
-
-        return data
-
-    def update(self, payload: dict):
-        logger.debug(f'New data received: {payload}')
-
-        timestamp = payload['timestamp']
-        time = datetime.fromtimestamp(timestamp)
-
-        if datetime.now() - time > timedelta(hours=5):
-            logger.warning(f'Data dropped due to server <-> IoT device time difference')
-            return
-
-        payload.pop('timestamp')
-
-        sensor: str
-        for category, values in payload.items():
-            if category.lower() not in self.data:
-                self.data[category] = dict()
-
-            parser = self.PARSERS[category]()
-            elements = parser.parse(category=values, time=time)
-
-            for name, element in elements.items():
-                if name not in self.data[category]:
-                    self.data[category][name] = element
-                else:
-                    self.data[category][name] = pd.concat([self.data[category][name], element])
-
-            self.save_dfs(self.data[category], category)
-
-    def save_dfs(self, dfs: dict, sub_path: str = ''):
-        df: pd.DataFrame
-        for name, df in dfs.items():
-            self.save_df(df, name, sub_path)
-
-    def save_df(self, df: pd.DataFrame, name: str, sub_path: str = ''):
-        root = self.config['BACKEND']['data_path']
-        relative_path = os.path.join(root, sub_path)
-
-        if not os.path.exists(relative_path):
-            os.mkdir(relative_path)
-
-        filepath = os.path.join(root, sub_path, f'{name}.csv')
-        logger.debug(f'Saving {name} DataFrame to {filepath}...')
-        df.to_csv(filepath, columns=df.columns, index=False)
-        logger.debug(f'Saved.')
+        config = self.config.get('FRONTEND', {})
+        self.title = config.get('title', 'Greenhouse')
+        self.interval = config.get('interval', 2)
+        self.max_points = config.get('max_points', 2000)
+        self.graphs = config.get('graphs', DEFAULT_GRAPHS)
+
+        self.backend = Backend(config_path)
+        sensors = self.backend.data.setdefault('sensors', {})
+        self.things = {element: sensors.setdefault(element, Thing()) for element in self.graphs}
+        self._version = 0
+        self._changed = threading.Condition()
+        [thing.add_observer(self) for thing in self.things.values()]
+
+    def update(self, payload):
+        with self._changed:
+            self._version += 1
+            self._changed.notify_all()
+
+    def wait(self, version: int, timeout: float = None) -> int:
+        # Returns at once if rows arrived after `version`, otherwise sleeps until they do or `timeout` expires
+        with self._changed:
+            self._changed.wait_for(lambda: self._version != version, timeout)
+            return self._version
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def latest(self, element: str) -> str:
+        # Taken from the decoded messages, so it may be ahead of the rows stored in the things
+        latest = self.backend.latest.get().get(element)
+        return '-' if latest is None else f'{latest[1]} at {latest[0]:%Y-%m-%d %H:%M:%S}'
+
+    def rows_after(self, element: str, cursor: pd.Timestamp = None) -> pd.DataFrame:
+        thing = self.things[element]
+        if cursor is None:
+            return thing.latest(self.max_points)
+        return thing.range(cursor + pd.Timedelta(1, 'ns'))
+
+    def close(self):
+        self.backend.close()
 
     @staticmethod
     def init_logger(logs_path):
@@ -96,23 +74,57 @@ class Dashboard(Observer):
         logger.add(os.path.join(logs_path, '{time:YYYY-MM-DD}.log'), format=log_format,
                    colorize=False, compression='zip', rotation='00:00')
 
-    def init_subscriber(self):
-        logger.info(f'Setting up subscriber...')
-        config = self.config['MQTT_BROKER']
-        broker = config['address']
-        port = config['port']
-        qos = config['qos']
-        topic = config['topic']
-        mqtt_id = config['id']
 
-        self.subscriber = Subscriber(broker, port, topic, qos, mqtt_id)
-        self.subscriber.connect()
-        self.subscriber.start()
-        self.subscriber.add_observer(self)
-        logger.success('Subscriber ready.')
+@st.cache_resource
+def get_dashboard(config_path: str) -> Dashboard:
+    # Streamlit handles SIGTERM itself and then exits normally, which runs the ordered backend shutdown
+    dashboard = Dashboard(config_path)
+    atexit.register(dashboard.close)
+    return dashboard
+
+
+def read_new_rows(dashboard: Dashboard, session) -> dict:
+    # Appends the rows after the session's cursor to its own bounded frames, returns the new rows per element
+    frames = session.setdefault('frames', {})
+    cursors = session.setdefault('cursors', {})
+    new_rows = {}
+    for element in dashboard.graphs:
+        rows = dashboard.rows_after(element, cursors.get(element))
+        if not len(rows):
+            continue
+        rows = rows.set_index('datetime')[['value']]
+        frame = frames.get(element)
+        frames[element] = rows if frame is None else pd.concat((frame, rows)).iloc[-dashboard.max_points:]
+        cursors[element] = rows.index[-1]
+        new_rows[element] = rows
+    return new_rows
+
+
+def main():
+    dashboard = get_dashboard(os.environ.get('config_file', './config.yaml'))
+    st.title(dashboard.title)
+
+    version = dashboard.version
+    read_new_rows(dashboard, st.session_state)
+    frames = st.session_state['frames']
+    charts = {}
+    latest = {}
+    for element, title in dashboard.graphs.items():
+        st.subheader(title)
+        latest[element] = st.empty()
+        latest[element].caption(f'Latest: {dashboard.latest(element)}')
+        charts[element] = st.line_chart(frames.get(element, pd.DataFrame({'value': pd.Series(dtype='float32')})))
+
+    # Sleeps until rows arrive, then at least `interval` seconds so bursts reach the browser as one update.
+    # Streamlit stops the loop by raising from the next st call when the session goes away or reruns.
+    while True:
+        version = dashboard.wait(version, timeout=60)
+        for element, frame in read_new_rows(dashboard, st.session_state).items():
+            charts[element].add_rows(frame)
+        for element, placeholder in latest.items():
+            placeholder.caption(f'Latest: {dashboard.latest(element)}')
+        time.sleep(dashboard.interval)
 
 
 if __name__ == '__main__':
-    dashboard = Dashboard()
-    while True:
-        pass
+    main()
@@ -5,38 +5,80 @@ import sys
 import os
 from loguru import logger
 from backend import Thing
+from payload import DEFAULT_DEVICE
 from observer_pattern import Observer
-from sqlalchemy import create_engine
-from time import sleep
+from db_writer import BatchWriter, make_engine
+from metrics import Histogram
+from service import Service
+
+DB_UPDATE_SECONDS = Histogram('greenhouse_db_updater_seconds', 'Time spent queueing rows in DBUpdater.update',
+                              ('table',))
 
 log_format = '<light-black>{time:YYYY-MM-DD HH:mm:ss.SSS}</light-black>' \
              ' <level>{name}.{function}@{line} | {level}: {message}</level>'
 
 
 class DBUpdater(Observer):
-    def __init__(self, schema: str, table: str, thing: Thing, conn):
+    def __init__(self, schema: str, table: str, thing: Thing, writer: BatchWriter, key: tuple = ('datetime',)):
         self.schema = schema
         self.table_name = table
         thing.add_observer(self)
-        self.conn = conn
+        self.writer = writer
+        # Rows whose key is already in the table are skipped, None to append everything
+        self.key = key
+        self.timer = DB_UPDATE_SECONDS.labels(table)
 
     def update(self, payload):
         payload: pd.DataFrame
-        payload.to_sql(name=self.table_name,
-                       schema=self.schema,
-                       con=self.conn,
-                       if_exists='append')
+        with self.timer.time():
+            self.writer.add(self.schema, self.table_name, payload, self.key)
+
+
+def init_db_writer(db_config: dict) -> BatchWriter:
+    return BatchWriter(make_engine(db_config),
+                       batch_rows=db_config.get('batch_rows', 500),
+                       flush_interval=db_config.get('flush_interval', 2.0),
+                       retries=db_config.get('retries', 3))
+
+
+def init_updaters(backend: Backend, db_writer: BatchWriter) -> list:
+    data = backend.data
+    sensors = data.setdefault('sensors', {})
+    key = ('datetime',) if backend.config['DATABASE'].get('deduplicate', True) else None
+    updaters = [DBUpdater('data', 'temp_in', sensors.setdefault('temp_in', Thing()), db_writer, key),
+                DBUpdater('data', 'temp_out', sensors.setdefault('temp_out', Thing()), db_writer, key),
+                DBUpdater('data', 'moisture', sensors.setdefault('MoistureReader', Thing()), db_writer, key)]
+
+    return updaters
+
+
+def attach_updaters(backend: Backend):
+    # Runs in every ingest worker process: only the one owning the default device feeds the database
+    if not backend.owns(DEFAULT_DEVICE):
+        return
+    db_writer = init_db_writer(backend.config['DATABASE'])
+    backend.updaters = init_updaters(backend, db_writer)
+    backend.close_hooks.append(db_writer.close)
 
 
 class Dashboard:
     def __init__(self, config_path='./config.yaml'):
         with open(config_path, 'r') as file:
             self.config = yaml.safe_load(file)
-        self.backend = Backend(config_path)
         self.init_logger(self.config['LOGGER']['path'])
-        self.db_engine = self.init_db_engine()
-        self.db_connection = self.init_db_connection()
-        self.updaters = self.init_updaters()
+        self.backend = Backend(config_path, initializer=attach_updaters)
+        self.db_writer = None
+        self.updaters = []
+        if self.backend.workers is None:
+            self.db_writer = init_db_writer(self.config['DATABASE'])
+            self.updaters = init_updaters(self.backend, self.db_writer)
+
+    def shutdown_steps(self) -> list:
+        # MQTT first so nothing new arrives, then the backend drains and flushes, the database connection last
+        steps = [('mqtt', self.backend.stop_subscriber), ('backend', self.backend.close)]
+        if self.db_writer is not None:
+            steps.append(('database', self.db_writer.close))
+        return steps
 
     def init_logger(self, logs_path):
         logger.remove()
@@ -44,30 +86,7 @@ class Dashboard:
         logger.add(os.path.join(logs_path, '{time:YYYY-MM-DD}.log'), format=log_format,
                    colorize=False, compression='zip', rotation='00:00')
 
-    def init_db_engine(self):
-        db_config = self.config['DATABASE']
-        connection_string = f'postgresql+psycopg2://{db_config["user"]}:{db_config["password"]}@' \
-                            f'{db_config["host"]}:5432/{db_config["database"]}'
-        engine = create_engine(connection_string, isolation_level='SERIALIZABLE')
-        return engine
-
-    @logger.catch
-    def init_db_connection(self):
-        conn = self.db_engine.connect()
-        return conn
-
-    def init_updaters(self):
-        data = self.backend.data
-        sensors = data.get('sensors', {})
-        updaters = [DBUpdater('data', 'temp_in', sensors.setdefault('temp_in', Thing()), self.db_connection),
-                    DBUpdater('data', 'temp_out', sensors.setdefault('temp_out', Thing()), self.db_connection),
-                    DBUpdater('data', 'moisture', sensors.setdefault('MoistureReader', Thing()), self.db_connection)]
-
-        return updaters
-
 
 if __name__ == '__main__':
     dashboard = Dashboard(os.environ['config_file'])
-
-    while True:
-        sleep(60)
+    Service('Dashboard', dashboard.shutdown_steps()).run()
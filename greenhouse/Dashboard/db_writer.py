@@ -0,0 +1,256 @@
+import csv
+import threading
+from io import StringIO
+from time import monotonic, sleep
+import pandas as pd
+from loguru import logger
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from metrics import Counter, Histogram
+from parsers import widen
+
+INSERT_SECONDS = Histogram('greenhouse_db_insert_seconds', 'Latency of a batch insert into the database')
+ROWS_WRITTEN = Counter('greenhouse_db_rows_written', 'Rows written to the database')
+INSERT_FAILURES = Counter('greenhouse_db_insert_failures', 'Failed batch inserts, retries included')
+ROWS_DROPPED = Counter('greenhouse_db_rows_dropped', 'Rows dropped because too many were pending')
+
+SQLITE_MAX_VARIABLES = 999
+
+
+def make_engine(db_config: dict) -> Engine:
+    url = db_config.get('url')
+    if url is None:
+        url = f'postgresql+psycopg2://{db_config["user"]}:{db_config["password"]}@' \
+              f'{db_config["host"]}:{db_config.get("port", 5432)}/{db_config["database"]}'
+
+    if url.startswith('sqlite'):
+        return create_engine(url)
+
+    return create_engine(url,
+                         pool_size=db_config.get('pool_size', 5),
+                         max_overflow=db_config.get('max_overflow', 5),
+                         pool_pre_ping=True,
+                         pool_recycle=db_config.get('pool_recycle', 1800))
+
+
+def copy_insert(table, conn, keys, data_iter):
+    buffer = StringIO()
+    csv.writer(buffer).writerows(data_iter)
+    buffer.seek(0)
+
+    columns = ', '.join(f'"{key}"' for key in keys)
+    name = f'"{table.schema}"."{table.name}"' if table.schema else f'"{table.name}"'
+    with conn.connection.cursor() as cursor:
+        cursor.copy_expert(f'COPY {name} ({columns}) FROM STDIN WITH CSV', buffer)
+
+
+def copy_insert_ignore(table, conn, keys, data_iter):
+    # COPY into a temporary table, then move the rows whose key is not taken yet
+    buffer = StringIO()
+    csv.writer(buffer).writerows(data_iter)
+    buffer.seek(0)
+
+    columns = ', '.join(f'"{key}"' for key in keys)
+    name = f'"{table.schema}"."{table.name}"' if table.schema else f'"{table.name}"'
+    staging = f'"{table.name}_staging"'
+    with conn.connection.cursor() as cursor:
+        cursor.execute(f'CREATE TEMPORARY TABLE {staging} (LIKE {name} INCLUDING DEFAULTS) ON COMMIT DROP')
+        cursor.copy_expert(f'COPY {staging} ({columns}) FROM STDIN WITH CSV', buffer)
+        cursor.execute(f'INSERT INTO {name} ({columns}) SELECT {columns} FROM {staging} ON CONFLICT DO NOTHING')
+
+
+def insert_ignore(table, conn, keys, data_iter):
+    dialect = {'sqlite': sqlite, 'postgresql': postgresql}[conn.dialect.name]
+    rows = [dict(zip(keys, row)) for row in data_iter]
+    conn.execute(dialect.insert(table.table).on_conflict_do_nothing(), rows)
+
+
+class BatchWriter:
+    """
+    Gathers rows for every table and writes each table's batch with a single statement (COPY on
+    PostgreSQL, multi-row INSERT elsewhere) once `batch_rows` rows are pending or `flush_interval` seconds
+    after the first pending row. Failed flushes are retried with exponential backoff; the pool's pre-ping
+    replaces dead connections in between.
+
+    All writes happen on the flusher thread: `add` only queues the rows and wakes it, so a slow or
+    unreachable database never blocks the caller. Past `max_pending_rows` new rows are dropped. Errors
+    of the driver itself, e.g. from COPY on the raw psycopg2 cursor, are retried like SQLAlchemy's.
+    """
+
+    def __init__(self, engine: Engine, batch_rows: int = 500, flush_interval: float = 2.0,
+                 retries: int = 3, retry_delay: float = 1.0, max_pending_rows: int = 100_000):
+        self.engine = engine
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_pending_rows = max_pending_rows
+        self.dialect = engine.dialect.name
+        # The raw cursor used by COPY raises the driver's exceptions, not SQLAlchemy's wrappers
+        self._errors = (DBAPIError, engine.dialect.dbapi.Error) if engine.dialect.dbapi else (DBAPIError,)
+        self._pending = {}  # (schema, table) -> [DataFrame]
+        self._keys = {}  # (schema, table) -> unique key columns, rows with a taken key are skipped
+        self._indexed = set()
+        self._pending_rows = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._started = monotonic()
+        self._rows = 0
+        self._flushes = 0
+        self._flush_time = 0.0
+        self._last_flush_latency = 0.0
+        self._max_flush_latency = 0.0
+        self._dropping = False
+        self._stop = threading.Event()
+        self._rows_pending = threading.Event()
+        self._batch_full = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name='db-writer', daemon=True)
+        self._flusher.start()
+
+    def add(self, schema: str, table: str, rows: pd.DataFrame, key: tuple = None):
+        with self._lock:
+            if self._pending_rows + len(rows) > self.max_pending_rows:
+                ROWS_DROPPED.inc(len(rows))
+                if not self._dropping:
+                    logger.error(f'Dropping rows for {table}: {self._pending_rows} rows are waiting for the database')
+                    self._dropping = True
+                return
+            if key:
+                self._keys[(schema, table)] = tuple(key)
+            self._pending.setdefault((schema, table), []).append(rows)
+            self._pending_rows += len(rows)
+            self._rows_pending.set()
+            if self._pending_rows >= self.batch_rows:
+                self._batch_full.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._pending_rows = 0
+                self._dropping = False
+                self._rows_pending.clear()
+                self._batch_full.clear()
+
+            for (schema, table), frames in pending.items():
+                self._write(schema, table, pd.concat(frames))
+
+    def close(self):
+        self._stop.set()
+        self._rows_pending.set()
+        self._batch_full.set()
+        self._flusher.join()
+        self.flush()
+        self.engine.dispose()
+        logger.info(f'Database writer closed: {self.stats()}')
+
+    def stats(self) -> dict:
+        elapsed = monotonic() - self._started
+        return {'rows': self._rows,
+                'flushes': self._flushes,
+                'pending_rows': self._pending_rows,
+                'rows_per_second': self._rows / elapsed if elapsed else 0.0,
+                'last_flush_latency': self._last_flush_latency,
+                'mean_flush_latency': self._flush_time / self._flushes if self._flushes else 0.0,
+                'max_flush_latency': self._max_flush_latency}
+
+    def _flush_loop(self):
+        # Sleeps while nothing is pending, then lets the batch fill for up to `flush_interval` seconds
+        while True:
+            self._rows_pending.wait()
+            self._batch_full.wait(self.flush_interval)
+            if self._stop.is_set():
+                return
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(f'Database flush failed: {e}')
+
+    def insert(self, schema: str, table: str, frame: pd.DataFrame, key: tuple = None) -> bool:
+        """Writes `frame` right away on the calling thread, with retries; False once they are exhausted."""
+        frame = widen(frame)
+        # SQLite has no schemas: the stand-in database keeps every table in its main schema.
+        if self.dialect == 'sqlite':
+            schema = None
+            method = 'multi'
+            chunksize = max(1, SQLITE_MAX_VARIABLES // (len(frame.columns) + 1))
+        elif self.dialect == 'postgresql':
+            method = copy_insert
+            chunksize = None
+        else:
+            method = 'multi'
+            chunksize = self.batch_rows
+
+        if key and self.dialect in ('sqlite', 'postgresql') and self._ensure_key(schema, table, frame, key):
+            method = insert_ignore if self.dialect == 'sqlite' else copy_insert_ignore
+
+        for attempt in range(self.retries + 1):
+            start = monotonic()
+            try:
+                with self.engine.begin() as conn:
+                    frame.to_sql(name=table, schema=schema, con=conn, if_exists='append',
+                                 method=method, chunksize=chunksize)
+            except self._errors as error:
+                INSERT_FAILURES.inc()
+                if attempt == self.retries:
+                    logger.error(f'Giving up writing {len(frame)} rows to {table}: {error}')
+                    return False
+                delay = self.retry_delay * 2 ** attempt
+                logger.warning(f'Writing {len(frame)} rows to {table} failed, retrying in {delay}s: {error}')
+                sleep(delay)
+            else:
+                latency = monotonic() - start
+                INSERT_SECONDS.observe(latency)
+                ROWS_WRITTEN.inc(len(frame))
+                self._rows += len(frame)
+                self._flushes += 1
+                self._flush_time += latency
+                self._last_flush_latency = latency
+                self._max_flush_latency = max(self._max_flush_latency, latency)
+                logger.debug(f'Wrote {len(frame)} rows to {table} in {latency * 1000:.1f}ms')
+                return True
+
+    def _write(self, schema: str, table: str, frame: pd.DataFrame):
+        try:
+            written = self.insert(schema, table, frame, self._keys.get((schema, table)))
+        except Exception as e:
+            # Not a database error: the same rows would fail again, so they are not queued back
+            ROWS_DROPPED.inc(len(frame))
+            logger.exception(f'Dropping {len(frame)} rows for {table}: {e}')
+            return
+        if not written:
+            self._requeue(schema, table, frame)
+
+    def _ensure_key(self, schema: str, table: str, frame: pd.DataFrame, key: tuple) -> bool:
+        # Creates the table if needed and a unique index on `key`; False if the existing rows prevent it
+        if (schema, table) in self._indexed:
+            return True
+
+        index = f'{table}_{"_".join(key)}_key'
+        name = f'"{schema}"."{table}"' if schema else f'"{table}"'
+        columns = ', '.join(f'"{column}"' for column in key)
+        try:
+            with self.engine.begin() as conn:
+                if not inspect(conn).has_table(table, schema=schema):
+                    frame.iloc[:0].to_sql(name=table, schema=schema, con=conn)
+                conn.exec_driver_sql(f'CREATE UNIQUE INDEX IF NOT EXISTS "{index}" ON {name} ({columns})')
+        except self._errors as error:
+            logger.error(f'Cannot add a unique index on {table} ({", ".join(key)}), duplicates will be written: '
+                         f'{error}')
+            self._keys.pop((schema, table), None)
+            return False
+
+        self._indexed.add((schema, table))
+        return True
+
+    def _requeue(self, schema: str, table: str, frame: pd.DataFrame):
+        with self._lock:
+            if self._pending_rows + len(frame) > self.max_pending_rows:
+                ROWS_DROPPED.inc(len(frame))
+                logger.error(f'Dropping {len(frame)} rows for {table}: too many rows pending')
+                return
+            self._pending.setdefault((schema, table), []).insert(0, frame)
+            self._pending_rows += len(frame)
+            self._rows_pending.set()
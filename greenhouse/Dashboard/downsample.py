@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+
+
+def as_float(values) -> np.ndarray:
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values):
+        return values.to_numpy(dtype=float)
+    return pd.to_datetime(values, utc=True).to_numpy(dtype='datetime64[ns]').astype(np.int64).astype(float)
+
+
+def lttb(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets: returns the indices of `points` samples of (x, y), x sorted, that
+    keep the visual shape of the series. The first and last samples are always kept.
+    """
+    size = len(x)
+    if points >= size - 2 or points < 3:
+        return np.arange(size)
+
+    # The samples between the first and the last one are split in `points - 2` buckets [start, end)
+    edges = (np.arange(points - 1) * (size - 2) / (points - 2)).astype(np.int64) + 1
+    edges[-1] = size - 1
+    starts, ends = edges[:-1], edges[1:]
+
+    # Average of every bucket, the third corner of the triangles of the previous bucket
+    sums_x, sums_y = np.add.reduceat(x[1:-1], starts - 1), np.add.reduceat(y[1:-1], starts - 1)
+    counts = ends - starts
+    averages_x = np.r_[sums_x / counts, x[-1]]
+    averages_y = np.r_[sums_y / counts, y[-1]]
+
+    selected = np.empty(points, dtype=np.int64)
+    selected[0], selected[-1] = 0, size - 1
+    previous = 0
+    for bucket, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        next_x, next_y = averages_x[bucket + 1], averages_y[bucket + 1]
+        areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+
+    return selected
+
+
+def min_max(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """
+    Keeps the minimum and the maximum of each of `points // 2` equal-width x buckets (one per pixel
+    column when `points` is twice the plot width), in x order.
+    """
+    size = len(x)
+    if points >= size or points < 2:
+        return np.arange(size)
+
+    buckets = np.minimum(((x - x[0]) / (x[-1] - x[0] or 1) * (points // 2)).astype(np.int64), points // 2 - 1)
+    order = np.lexsort((y, buckets))
+    first = np.r_[True, buckets[order][1:] != buckets[order][:-1]]
+    last = np.r_[buckets[order][1:] != buckets[order][:-1], True]
+    return np.unique(np.r_[order[first], order[last]])
+
+
+METHODS = {'lttb': lttb, 'min_max': min_max}
+
+
+def downsample(frame: pd.DataFrame, x: str, y: str, points: int, method: str = 'lttb') -> pd.DataFrame:
+    frame = frame.dropna(subset=[y])
+    if len(frame) <= points:
+        return frame
+
+    x_values = as_float(frame[x])
+    order = np.argsort(x_values, kind='stable')
+    indices = order[METHODS[method](x_values[order], frame[y].to_numpy(dtype=float)[order], points)]
+    return frame.iloc[indices]
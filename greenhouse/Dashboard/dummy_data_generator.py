@@ -1,3 +1,6 @@
+import argparse
+import math
+import threading
 import yaml
 import paho.mqtt.client as mqtt
 from paho.mqtt.client import MQTTMessageInfo
@@ -5,6 +8,8 @@ import random
 import json
 import time
 
+DAY_SECONDS = 24 * 60 * 60
+
 
 class Generator:
 	def __init__(self, config_path='./config.yaml', delay: int = 3):
@@ -24,12 +29,11 @@ class Generator:
 	def new_payload() -> str:
 		payload = {"sensors": {"LightReader": random.randint(0, 100), "MoistureReader": random.randint(0, 100)},
 				   "actuators": {"LED": {"available": bool(random.randint(0, 1)), "info": "0%"},
-								 "Pump": {"available": bool(random.randint(0, 1)), "info": ""},
-								 "MoistureController": {"enabled": bool(random.randint(0, 1)),
-														"busy": bool(random.randint(0, 1))},
-								 "LightController": {"enabled": bool(random.randint(0, 1)),
-													 "busy": bool(random.randint(0, 1))}},
-				   "controllers": {},
+								 "Pump": {"available": bool(random.randint(0, 1)), "info": ""}},
+				   "controllers": {"MoistureController": {"enabled": bool(random.randint(0, 1)),
+														  "busy": bool(random.randint(0, 1))},
+								   "LightController": {"enabled": bool(random.randint(0, 1)),
+													   "busy": bool(random.randint(0, 1))}},
 				   "timestamp": time.time()}
 
 		return json.dumps(payload)
@@ -51,6 +55,245 @@ class Generator:
 			time.sleep(self.delay)
 
 
+class SimulatedDevice:
+	"""
+	Greenhouse whose readings follow one day/night cycle with weather noise: light drives the inside
+	temperature above the outside one, the soil dries faster when it is hot and the pump waters it when it
+	gets too dry. Payloads have the ESP32's schema (a 'timestamp' plus the 'device' id).
+	"""
+
+	def __init__(self, device_id: str, seed: int = None):
+		self.id = device_id
+		self.random = random.Random(seed if seed is not None else device_id)
+		self.phase = self.random.uniform(-1800, 1800)  # Devices are not all at the same longitude
+		self.outside_base = self.random.uniform(8, 22)
+		self.insulation = self.random.uniform(3, 10)
+		self.clouds = 0.2
+		self.moisture = self.random.uniform(40, 90)
+		self.watering = False
+		self.last_time = None
+
+	def step(self, now: float):
+		elapsed = 0.0 if self.last_time is None else max(0.0, now - self.last_time)
+		self.last_time = now
+		# Clouds drift as a mean-reverting random walk, so consecutive light readings are correlated
+		elapsed_clouds = min(elapsed, 3600)
+		self.clouds += (0.2 - self.clouds) * elapsed_clouds / 3600 + self.random.gauss(0, 0.005) * math.sqrt(elapsed_clouds)
+		self.clouds = min(max(self.clouds, 0.0), 0.9)
+		if self.watering:
+			self.moisture = min(100.0, self.moisture + 2.0 * elapsed)
+			self.watering = self.moisture < 80
+		else:
+			self.moisture = max(0.0, self.moisture - (0.002 + 0.0002 * max(self.temperatures(now)[0] - 15, 0)) * elapsed)
+			self.watering = self.moisture < 30
+
+	def light(self, now: float) -> float:
+		sun = math.sin(2 * math.pi * ((now + self.phase) % DAY_SECONDS - DAY_SECONDS / 4) / DAY_SECONDS)
+		return max(sun, 0.0) * (1 - self.clouds) * 100
+
+	def temperatures(self, now: float) -> tuple:
+		# The outside temperature peaks mid-afternoon, three hours after the light
+		outside = self.outside_base + 6 * math.sin(2 * math.pi * ((now + self.phase - 3 * 3600) % DAY_SECONDS - DAY_SECONDS / 4) / DAY_SECONDS)
+		inside = outside + self.insulation * self.light(now) / 100
+		return inside, outside
+
+	def payload(self, now: float = None) -> str:
+		now = time.time() if now is None else now
+		self.step(now)
+		light = self.light(now)
+		temp_in, temp_out = self.temperatures(now)
+		noise = self.random.gauss
+		payload = {'timestamp': now,
+				   'device': self.id,
+				   'sensors': {'LightReader': round(min(max(light + noise(0, 1), 0), 100)),
+							   'MoistureReader': round(min(max(self.moisture + noise(0, 0.5), 0), 100)),
+							   'temp_in': round(temp_in + noise(0, 0.2), 2),
+							   'temp_out': round(temp_out + noise(0, 0.2), 2)},
+				   'actuators': {'LED': {'available': light < 20, 'info': f'{round(max(20 - light, 0) * 5)}%'},
+								 'Pump': {'available': not self.watering, 'info': ''}},
+				   'controllers': {'MoistureController': {'enabled': True, 'busy': self.watering},
+								   'LightController': {'enabled': True, 'busy': light < 20}}}
+
+		return json.dumps(payload)
+
+
+class LoadGenerator:
+	"""
+	Publishes for `devices` simulated devices at `rate` messages per second in total, on `connections`
+	MQTT clients that each own a slice of the devices and run on their own thread.
+
+	Every `burst_every` seconds the rate is multiplied by `burst_factor` for `burst_seconds` (e.g. devices
+	flushing their backlog after an outage); every `storm_every` seconds all the clients drop their
+	connection and reconnect at once, like a fleet after a broker restart.
+
+	Only the main thread reconnects a client, with its network loop stopped; publishers wait until their
+	client is connected again.
+	"""
+
+	def __init__(self, config_path='./config.yaml', devices: int = 1000, rate: float = 100, connections: int = 10,
+				 topic: str = 'greenhouse/{device}/telemetry', burst_every: float = 0, burst_factor: float = 5,
+				 burst_seconds: float = 10, storm_every: float = 0, duration: float = None):
+		with open(config_path, 'r') as file:
+			self.config = yaml.safe_load(file)
+
+		config = self.config['MQTT_BROKER']
+		self.broker = config['address']
+		self.port = config['port']
+		self.qos = config['qos']
+		self.topic = topic
+		self.rate = rate
+		self.burst_every = burst_every
+		self.burst_factor = burst_factor
+		self.burst_seconds = burst_seconds
+		self.storm_every = storm_every
+		self.duration = duration
+		self.devices = [SimulatedDevice(f'device-{index}') for index in range(devices)]
+		self.clients = [mqtt.Client(f'generator-{index}', userdata=index)
+						for index in range(min(connections, devices))]
+		self.connected = [threading.Event() for _ in self.clients]
+		self.disconnected = set()  # indexes of the clients to reconnect
+		for client in self.clients:
+			client.on_connect = self.on_connect
+			client.on_disconnect = self.on_disconnect
+		self.published = 0
+		self.failed = 0
+		self.reconnects = 0
+		self.counters_lock = threading.Lock()
+		self.stop = threading.Event()
+		self.started = None
+
+	def current_rate(self, now: float) -> float:
+		if self.burst_every and (now - self.started) % self.burst_every < self.burst_seconds:
+			return self.rate * self.burst_factor
+		return self.rate
+
+	def on_connect(self, client, index, flags, rc):
+		if rc == mqtt.CONNACK_ACCEPTED:
+			self.connected[index].set()
+
+	def on_disconnect(self, client, index, rc):
+		self.connected[index].clear()
+		with self.counters_lock:
+			self.disconnected.add(index)
+
+	def publish_loop(self, index: int):
+		client = self.clients[index]
+		connected = self.connected[index]
+		devices = self.devices[index::len(self.clients)]
+		share = len(devices) / len(self.devices)
+		next_send = time.monotonic()
+		position = 0
+		while not self.stop.is_set():
+			if not connected.is_set():
+				connected.wait(1)
+				next_send = time.monotonic()
+				continue
+			now = time.monotonic()
+			if now < next_send:
+				self.stop.wait(next_send - now)
+				continue
+			next_send += 1 / (self.current_rate(now) * share)
+
+			device = devices[position % len(devices)]
+			position += 1
+			response: MQTTMessageInfo
+			response = client.publish(self.topic.format(device=device.id), device.payload(), self.qos)
+			with self.counters_lock:
+				if response.rc == mqtt.MQTT_ERR_SUCCESS:
+					self.published += 1
+				else:
+					self.failed += 1
+			if response.rc == mqtt.MQTT_ERR_NO_CONN:
+				connected.clear()
+				with self.counters_lock:
+					self.disconnected.add(index)
+
+	def reconnect(self, index: int):
+		# Called from the main thread only: paho's network thread is stopped first so that it does not
+		# reconnect the same client concurrently
+		client = self.clients[index]
+		client.loop_stop()
+		with self.counters_lock:
+			self.disconnected.discard(index)
+		if self.connected[index].is_set():
+			# paho's network thread reconnected it on its own in the meantime
+			client.loop_start()
+			return
+
+		while not self.stop.is_set():
+			try:
+				if client.reconnect() == mqtt.MQTT_ERR_SUCCESS:
+					with self.counters_lock:
+						self.reconnects += 1
+					client.loop_start()
+					return
+			except OSError as e:
+				print(f'Reconnecting failed: {e}')
+			self.stop.wait(random.uniform(0.5, 2))
+
+	def storm(self):
+		print(f'Reconnect storm: dropping {len(self.clients)} connections')
+		[client.disconnect() for client in self.clients]
+		[self.reconnect(index) for index in range(len(self.clients))]
+
+	def loop(self, report_interval: float = 10):
+		for client in self.clients:
+			client.connect(self.broker, self.port)
+			client.loop_start()
+
+		self.started = time.monotonic()
+		threads = [threading.Thread(target=self.publish_loop, args=(index,), name=f'publisher-{index}', daemon=True)
+				   for index in range(len(self.clients))]
+		[thread.start() for thread in threads]
+
+		last_storm = last_report = self.started
+		last_published = 0
+		try:
+			while not self.stop.wait(1):
+				now = time.monotonic()
+				if self.duration is not None and now - self.started >= self.duration:
+					break
+				if self.storm_every and now - last_storm >= self.storm_every:
+					last_storm = now
+					self.storm()
+				with self.counters_lock:
+					disconnected = sorted(self.disconnected)
+				[self.reconnect(index) for index in disconnected]
+				if now - last_report >= report_interval:
+					print(f'{(self.published - last_published) / (now - last_report):.0f} msg/s | '
+						  f'published {self.published} | failed {self.failed} | reconnects {self.reconnects}')
+					last_report, last_published = now, self.published
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self.stop.set()
+			[thread.join() for thread in threads]
+			for client in self.clients:
+				client.disconnect()
+				client.loop_stop()
+			print(f'Published {self.published} messages ({self.failed} failed, {self.reconnects} reconnects) '
+				  f'in {time.monotonic() - self.started:.0f}s')
+
+
 if __name__ == '__main__':
-	generator = Generator()
-	generator.loop()
+	parser = argparse.ArgumentParser(description='Publishes dummy greenhouse data; with --devices, simulates a fleet.')
+	parser.add_argument('--config', default='./config.yaml')
+	parser.add_argument('--devices', type=int, help='number of simulated devices (load generator mode)')
+	parser.add_argument('--rate', type=float, default=100, help='messages per second over all the devices')
+	parser.add_argument('--connections', type=int, default=10)
+	parser.add_argument('--topic', default='greenhouse/{device}/telemetry')
+	parser.add_argument('--burst-every', type=float, default=0, help='seconds between bursts, 0 for none')
+	parser.add_argument('--burst-factor', type=float, default=5)
+	parser.add_argument('--burst-seconds', type=float, default=10)
+	parser.add_argument('--storm-every', type=float, default=0, help='seconds between reconnect storms, 0 for none')
+	parser.add_argument('--duration', type=float, help='seconds to run, forever if omitted')
+	args = parser.parse_args()
+
+	if args.devices is None:
+		generator = Generator(args.config)
+		generator.loop()
+	else:
+		generator = LoadGenerator(args.config, args.devices, args.rate, args.connections, args.topic,
+								  args.burst_every, args.burst_factor, args.burst_seconds, args.storm_every,
+								  args.duration)
+		generator.loop()
@@ -1,9 +1,89 @@
+import os
+import threading
+from collections import deque
 import dash
 from dash import dcc
 from dash import html
+from dash.dependencies import Input, Output, State
 from loguru import logger
+import pandas as pd
 import yaml
-from backend import Backend
+from backend import Backend, Thing, DEFAULT_GRAPHS
+from graphs import LineGraph
+from service import Service
+
+
+class FigureCache:
+    """
+    Server-side state shared by every browser session. Once per interval `refresh` takes the points each
+    graph received since the previous refresh as one numbered delta; sessions only remember the last
+    version they have seen and get the deltas after it. Full figures are built at most once per version,
+    for new sessions and for those that fell more than `history` versions behind. A figure only holds the
+    rows up to the last point put in a delta, later rows reach its sessions through the next deltas.
+    """
+
+    def __init__(self, graphs: list, history: int = 60):
+        self.graphs = {graph.id: graph for graph in graphs}
+        self.version = 0
+        self._deltas = deque(maxlen=history)  # (version, {graph_id: {'x': [...], 'y': [...]}})
+        self._figures = {}  # graph_id -> full figure at self.version
+        self._merged = {}  # session version -> deltas merged up to self.version
+        # graph_id -> time of the last row that is not pending, i.e. already in the things or in a delta
+        self._ends = {graph_id: self.last_time(graph) for graph_id, graph in self.graphs.items()}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def last_time(graph: LineGraph) -> pd.Timestamp:
+        latest = graph.thing.latest()
+        return latest[graph.axes[0]].iloc[-1] if len(latest) else pd.Timestamp(0, tz='UTC')
+
+    def refresh(self):
+        with self._lock:
+            self._add_pending()
+
+    def figures(self) -> tuple:
+        with self._lock:
+            if not self._figures:
+                # Pending points go out as a delta first: the figure must not hold points a later delta repeats
+                self._add_pending()
+                for graph_id, graph in self.graphs.items():
+                    self._figures[graph_id] = graph.get_figure(end=self._ends[graph_id] + pd.Timedelta(1, 'ns'))
+            return dict(self._figures), self.version
+
+    def _add_pending(self):
+        delta = {}
+        for graph_id, graph in self.graphs.items():
+            points = graph.latest_data()
+            if points['x']:
+                delta[graph_id] = {'x': list(points['x']), 'y': list(points['y'])}
+                self._ends[graph_id] = max(self._ends[graph_id], max(points['x']))
+
+        if not delta:
+            return
+        self.version += 1
+        self._deltas.append((self.version, delta))
+        self._figures = {}
+        self._merged = {}
+
+    def since(self, version: int):
+        """Points added after `version` per graph id, or None when they are no longer all kept."""
+        with self._lock:
+            merged = self._merged.get(version)
+            if merged is not None:
+                return merged, self.version
+            if version is None or version > self.version or (self._deltas and version < self._deltas[0][0] - 1):
+                return None
+
+            merged = {}
+            for delta_version, delta in self._deltas:
+                if delta_version <= version:
+                    continue
+                for graph_id, points in delta.items():
+                    target = merged.setdefault(graph_id, {'x': [], 'y': []})
+                    target['x'].extend(points['x'])
+                    target['y'].extend(points['y'])
+            self._merged[version] = merged
+            return merged, self.version
 
 
 class Frontend:
@@ -11,13 +91,85 @@ class Frontend:
         with open(config_path, 'r') as file:
             self.config = yaml.safe_load(file)
 
-        self.backend = Backend
+        self.backend = backend
+        config = self.config.get('FRONTEND', {})
+        self.title = config.get('title', 'Greenhouse')
+        self.interval = config.get('interval', 2)
+
+        sensors = self.backend.data.setdefault('sensors', {})
+        self.elements = list(config.get('graphs', DEFAULT_GRAPHS))
+        self.graphs = [LineGraph(title, f'graph-{element}', sensors.setdefault(element, Thing()),
+                                 ('datetime', 'value'), y_title=element, x_title='Time',
+                                 max_points=config.get('max_points', 2000))
+                       for element, title in config.get('graphs', DEFAULT_GRAPHS).items()]
+        self.cache = FigureCache(self.graphs, config.get('history', 60))
+
+        self.app = dash.Dash(__name__, title=self.title)
+        self.app.layout = self.layout
+        self.init_callbacks()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._refresh_loop, name='frontend-refresh', daemon=True)
+        self._thread.start()
+
+    def layout(self):
+        # Called on every page load, so a new session starts from the latest shared figures
+        figures, version = self.cache.figures()
+        latest = self.latest_values()
+        return html.Div([html.H1(self.title),
+                         *[component for graph, text in zip(self.graphs, latest)
+                           for component in (html.Div(text, id=f'{graph.id}-latest'),
+                                             dcc.Graph(id=graph.id, figure=figures[graph.id]))],
+                         dcc.Store(id='version', data=version),
+                         dcc.Interval(id='interval', interval=self.interval * 1000)])
+
+    def init_callbacks(self):
+        outputs = [Output(graph.id, 'figure') for graph in self.graphs] + \
+                  [Output(graph.id, 'extendData') for graph in self.graphs] + \
+                  [Output('version', 'data')] + \
+                  [Output(f'{graph.id}-latest', 'children') for graph in self.graphs]
+        self.app.callback(outputs, Input('interval', 'n_intervals'), State('version', 'data'))(self.on_interval)
+
+    def on_interval(self, n_intervals, version):
+        # The latest values come straight from the decoded messages, ahead of the graphs
+        unchanged = [dash.no_update] * len(self.graphs)
+        values = self.latest_values()
+        update = self.cache.since(version)
+        if update is None:
+            figures, version = self.cache.figures()
+            return [figures[graph.id] for graph in self.graphs] + unchanged + [version] + values
 
+        deltas, latest = update
+        if latest == version:
+            return unchanged + unchanged + [dash.no_update] + values
+        extend = [({'x': [deltas[graph.id]['x']], 'y': [deltas[graph.id]['y']]}, [0], graph.max_points)
+                  if graph.id in deltas else dash.no_update for graph in self.graphs]
+        return unchanged + extend + [latest] + values
 
+    def latest_values(self) -> list:
+        latest = self.backend.latest.get()
+        return [f'Latest: {latest[element][1]} at {latest[element][0]:%Y-%m-%d %H:%M:%S}'
+                if element in latest else 'Latest: -' for element in self.elements]
 
+    def close(self):
+        self._stop.set()
+        self._thread.join()
 
+    def _refresh_loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.cache.refresh()
+            except Exception as e:
+                logger.exception(f'Figure refresh failed: {e}')
 
 
 if __name__ == "__main__":
-    frontend = Frontend()
-    frontend.app.run_server(debug=True)
+    config_path = os.environ.get('config_file', './config.yaml')
+    backend = Backend(config_path)
+    frontend = Frontend(backend, config_path)
+    config = frontend.config.get('FRONTEND', {})
+    # The web server runs on a daemon thread so that the main thread is free to handle the stop signals
+    threading.Thread(target=frontend.app.run_server, name='frontend-http', daemon=True,
+                     kwargs={'host': config.get('host', '127.0.0.1'), 'port': config.get('port', 8050)}).start()
+    Service('Frontend', [('mqtt', backend.stop_subscriber), ('frontend', frontend.close),
+                         ('backend', backend.close)]).run()
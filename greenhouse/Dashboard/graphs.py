@@ -4,6 +4,7 @@ import pandas as pd
 import plotly.graph_objs as go
 from backend import Thing
 from observer_pattern import Observer
+from downsample import downsample
 from threading import Lock
 
 
@@ -27,31 +28,35 @@ class SafeList:
         self._data = []
         self.mutex.release()
 
+    def pop_all(self) -> list:
+        with self.mutex:
+            data, self._data = self._data, []
+        return data
+
     def empty(self) -> bool:
         return len(self._data) == 0
 
 
 class LineGraph(dcc.Graph, Observer):
-    def __init__(self, title: str, graph_id: str, thing: Thing, axes: tuple, y_title: str, x_title: str = ''):
+    def __init__(self, title: str, graph_id: str, thing: Thing, axes: tuple, y_title: str, x_title: str = '',
+                 max_points: int = 2000, method: str = 'lttb'):
         self.x_title = x_title
         self.y_title = y_title
         self.title = title
         self.axes = axes
         self.thing = thing
+        self.max_points = max_points
+        self.method = method
         self._temp = SafeList()  # Each element is: (x, y)
+        self._figures = {}  # (x_range, max_points, end) -> figure, emptied when new data arrives
 
         self.thing.add_observer(self)
 
         self.type = 'lines'
-        figure = {'layout': {'title': title,
-                             'xaxis': {'title': x_title},
-                             'yaxis': {'title': y_title}},
-                  'data': [{'x': self.thing.data[axes[0]],
-                            'y': self.thing.data[axes[1]],
-                            'type': 'lines'}]}
-        super().__init__(figure=figure, id=graph_id)
+        super().__init__(figure=self.get_figure(), id=graph_id)
 
     def update(self, payload):
+        self._figures = {}
         self.add_data(payload)
 
     def _parse_data(self, new_data: pd.DataFrame) -> dict:
@@ -67,14 +72,29 @@ class LineGraph(dcc.Graph, Observer):
 
         [self._temp.append((x, y)) for x, y in zip(parsed['x'], parsed['y'])]
 
-    def get_figure(self) -> dict:
+    def get_figure(self, x_range: tuple = None, max_points: int = None, end=None) -> dict:
+        # Without `x_range`, the rows in memory before `end` (all of them by default)
+        max_points = max_points or self.max_points
+        key = (x_range, max_points, end)
+        figure = self._figures.get(key)
+        if figure is not None:
+            return figure
+
+        if x_range is not None:
+            data = self.thing.history(*x_range)
+        else:
+            data = self.data if end is None else self.thing.range(end=end)
+        if self.axes[1] in data:
+            data = downsample(data, self.axes[0], self.axes[1], max_points, self.method)
+
         figure = {'layout': {'title': self.title,
                              'xaxis': {'title': self.x_title},
                              'yaxis': {'title': self.y_title}},
-                  'data': [{'x': self.data[self.axes[0]],
-                            'y': self.data[self.axes[1]],
+                  'data': [{'x': data.get(self.axes[0], []),
+                            'y': data.get(self.axes[1], []),
                             'type': self.type}]}
 
+        self._figures[key] = figure
         return figure
 
     def get_scatter(self) -> Scatter:
@@ -89,7 +109,7 @@ class LineGraph(dcc.Graph, Observer):
             return {'x': [],
                     'y': []}
 
-        x_axes_data, y_axes_data = zip(*[e for e in self._temp.data])
-        self._temp.reset()
+        # Taken and emptied under the lock, so points added meanwhile wait for the next call instead of being lost
+        x_axes_data, y_axes_data = zip(*self._temp.pop_all())
         return {'x': x_axes_data,
                 'y': y_axes_data}
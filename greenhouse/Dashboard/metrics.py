@@ -0,0 +1,240 @@
+import threading
+from bisect import bisect_left
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from loguru import logger
+
+DEFAULT_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_NULL_TIMER = nullcontext()
+
+
+class Metric:
+    """
+    A named family of samples, one per combination of label values. Updates are plain attribute
+    increments: they are not locked, a rare lost increment between threads is the price of staying cheap
+    on the hot path. While `Metric.enabled` is False every update returns right away.
+    """
+    enabled = True
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._children = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children.setdefault(values, self._child())
+        return child
+
+    def _child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        # (suffix, {label: value}, value) for every child
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for suffix, labels, value in self._samples():
+            text = ','.join(f'{name}="{escape(str(label))}"' for name, label in labels.items())
+            lines.append(f'{self.name}{suffix}{{{text}}} {value!r}' if text else f'{self.name}{suffix} {value!r}')
+        return '\n'.join(lines)
+
+    def _label_dict(self, values: tuple) -> dict:
+        return dict(zip(self.label_names, values))
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        if Metric.enabled:
+            self.value += amount
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), registry=None):
+        super().__init__(name, documentation, labels, registry)
+        if not self.label_names:
+            self._default = self.labels()
+
+    def _child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        if Metric.enabled:
+            self._default.value += amount
+
+    def _samples(self):
+        return [('_total', self._label_dict(values), child.value) for values, child in list(self._children.items())]
+
+
+class Gauge(Metric):
+    """
+    Value read from `function()` at scrape time, e.g. a queue depth. With `labels`, `function` returns a
+    {(label values): value} dict instead of a number.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, function, labels: tuple = (), registry=None):
+        super().__init__(name, documentation, labels, registry)
+        self.function = function
+
+    def _samples(self):
+        try:
+            values = self.function()
+        except Exception as e:
+            logger.warning(f'Gauge {self.name} failed: {e}')
+            return []
+        if not self.label_names:
+            return [('', {}, float(values))]
+        return [('', self._label_dict(key), float(value)) for key, value in values.items()]
+
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        if Metric.enabled:
+            self.counts[bisect_left(self.bounds, value)] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self) if Metric.enabled else _NULL_TIMER
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram: _HistogramChild):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(perf_counter() - self.start)
+
+
+class Histogram(Metric):
+    """Observations counted in fixed `buckets` (upper bounds, in seconds for timings)."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS,
+                 registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labels, registry)
+        if not self.label_names:
+            self._default = self.labels()
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+    def _samples(self):
+        samples = []
+        for values, child in list(self._children.items()):
+            labels = self._label_dict(values)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+                cumulative += count
+                samples.append(('_bucket', dict(labels, le='+Inf' if bound == float('inf') else repr(bound)),
+                                cumulative))
+            samples.append(('_sum', labels, child.sum))
+            samples.append(('_count', labels, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric: Metric):
+        # A metric registered again under the same name (a new Backend, a reloaded module) replaces the old one
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None and existing.kind != metric.kind:
+                raise ValueError(f'Metric "{metric.name}" is already registered as a {existing.kind}')
+            self.metrics[metric.name] = metric
+
+    def unregister(self, name: str):
+        with self.lock:
+            self.metrics.pop(name, None)
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(address: str = '127.0.0.1', port: int = 9100, registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    handler = type('Handler', (_Handler,), {'registry': registry})
+    server = ThreadingHTTPServer((address, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info(f'Serving metrics on http://{address}:{port}/metrics')
+    return server
+
+
+def configure(config: dict):
+    """
+    Applies the METRICS config section: with `enabled: false` updates are skipped and no endpoint is
+    served. Returns the HTTP server, if any.
+    """
+    Metric.enabled = config.get('enabled', True)
+    if not Metric.enabled or not config.get('port'):
+        return None
+    try:
+        return start_server(config.get('address', '127.0.0.1'), config['port'])
+    except OSError as e:
+        logger.error(f'Cannot serve metrics on port {config["port"]}: {e}')
+        return None
@@ -0,0 +1,43 @@
+import argparse
+import os
+import pandas as pd
+from loguru import logger
+from storage import PartitionedStore, SegmentWriter
+
+
+def migrate(data_path: str, file_format: str = 'parquet', chunk_rows: int = 100_000, keep: bool = False):
+    csv_storage = SegmentWriter(data_path)
+    store = PartitionedStore(data_path, flush_rows=chunk_rows, file_format=file_format)
+
+    try:
+        for category, name in csv_storage.things():
+            filepath = os.path.join(data_path, category, f'{name}.csv')
+            logger.info(f'Migrating {filepath}...')
+            rows = 0
+            for chunk in pd.read_csv(filepath, chunksize=chunk_rows):
+                store.append(category, name, chunk)
+                rows += len(chunk)
+            store.flush()
+
+            if keep:
+                os.replace(filepath, f'{filepath}.migrated')
+            else:
+                os.remove(filepath)
+            logger.success(f'Migrated {rows} rows of {category}/{name}.')
+
+        store.compact(force=True)
+    finally:
+        store.close()
+        csv_storage.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert <data_path>/<category>/<name>.csv files into '
+                                                 'day-partitioned <data_path>/<category>/<name>/ directories.')
+    parser.add_argument('data_path')
+    parser.add_argument('--format', choices=list(PartitionedStore.FORMATS), default='parquet')
+    parser.add_argument('--chunk-rows', type=int, default=100_000)
+    parser.add_argument('--keep', action='store_true', help='rename the CSV files to *.csv.migrated instead of '
+                                                             'deleting them')
+    args = parser.parse_args()
+    migrate(args.data_path, args.format, args.chunk_rows, args.keep)
@@ -2,12 +2,19 @@ import paho.mqtt.client as mqtt
 from paho.mqtt.client import MQTTMessage
 from loguru import logger
 from observer_pattern import Observable
-import json
+from payload import try_decode, device_from_topic
+from metrics import Counter, Histogram
 from time import sleep
 
+MESSAGES = Counter('greenhouse_mqtt_messages_received', 'MQTT messages received')
+DECODE_SECONDS = Histogram('greenhouse_decode_seconds', 'Time spent decoding a payload')
+FANOUT_SECONDS = Histogram('greenhouse_observer_fanout_seconds', 'Time spent notifying the observers', ('source',))
+SUBSCRIBER_FANOUT = FANOUT_SECONDS.labels('subscriber')
+
 
 class Subscriber(Observable):
-    def __init__(self, broker: str, port: int, topic: str, qos: int, client_id: str = 'dashboard'):
+    def __init__(self, broker: str, port: int, topic, qos: int, client_id: str = 'dashboard',
+                 device_topic_level: int = None):
         super().__init__()
         self.client = mqtt.Client(client_id=client_id)
         self.client.on_connect = self.on_connect
@@ -17,6 +24,8 @@ class Subscriber(Observable):
         self.port = port
         self.topic = topic
         self.qos = qos
+        self.device_topic_level = device_topic_level
+        self.pipeline = None
 
     def on_connect(self, client, userdata, flags, rc):
         logger.debug(f'CONNACK: {rc}')
@@ -37,34 +46,35 @@ class Subscriber(Observable):
             self.client.reconnect()
             sleep(3)
 
-        self.client.subscribe(self.topic, self.qos)
+        if isinstance(self.topic, (list, tuple)):
+            self.client.subscribe([(topic, self.qos) for topic in self.topic])
+        else:
+            self.client.subscribe(self.topic, self.qos)
 
     def on_message(self, client, userdata, msg: MQTTMessage):
         logger.debug(f'New message: topic: {msg.topic} | qos: {msg.qos} | payload: {msg.payload}')
-        payload = self.parse_payload(msg.payload)
-        self.notify_observers(payload)
-
-    @staticmethod
-    def parse_payload(message) -> dict:
-        try:
-            payload = json.loads(message)
-        except json.decoder.JSONDecodeError as je:
-            logger.warning('Dropping payload; {je}')
-            return None
-        assert set(payload.keys()) == {'datetime', 'sensors', 'actuators', 'controllers'}
-        assert isinstance(payload['datetime'], str) or isinstance(payload['timestamp'], float)
-        assert isinstance(payload['sensors'], dict)
-        assert isinstance(payload['actuators'], dict)
-        assert isinstance(payload['controllers'], dict)
+        MESSAGES.inc()
+        if self.pipeline is not None:
+            self.pipeline.put(msg.topic, (msg.topic, msg.payload))
+            return
 
-        parsed = {'datetime': payload['datetime'],
-                  'sensors': payload['sensors'],
-                  'actuators': payload['actuators'],
-                  'controllers': payload['controllers']}
+        with DECODE_SECONDS.time():
+            payload = self.parse_payload(msg.payload, device_from_topic(msg.topic, self.device_topic_level))
+        with SUBSCRIBER_FANOUT.time():
+            self.notify_observers(payload)
 
-        return parsed
+    @staticmethod
+    def parse_payload(message, device: str = None) -> dict:
+        return try_decode(message, device)
 
     def start(self):
         logger.debug('Stating loop..')
         self.client.loop_start()
         logger.debug('Loop started')
+
+    def stop(self):
+        # Returns once paho's network thread has exited, so no message is delivered afterwards
+        logger.debug('Stopping loop...')
+        self.client.disconnect()
+        self.client.loop_stop()
+        logger.debug('Loop stopped')
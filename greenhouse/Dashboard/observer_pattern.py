@@ -1,21 +1,141 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from loguru import logger
+
+
 class Observer:
 	def update(self, payload):
 		raise NotImplementedError
 
 
+class ObserverQueue:
+	"""Payloads waiting for one observer, delivered in order by at most one executor thread at a time."""
+
+	def __init__(self, observer: Observer):
+		self.observer = observer
+		self.pending = deque()  # (enqueue time, payload)
+		self.running = False
+		self.delivered = 0
+		self.errors = 0
+		self.last_lag = 0.0
+		self.max_lag = 0.0
+
+
+class AsyncDispatcher:
+	"""
+	Delivers notifications on a thread pool instead of the notifying thread. Each observer has its own
+	queue, drained by one task at a time: an observer sees its payloads in order, slow observers only
+	delay themselves and an exception raised by `update` is logged without reaching the others.
+	`lag()` reports each observer's backlog; `flush` waits for the queues to empty and `close` flushes then
+	stops the pool.
+	"""
+
+	def __init__(self, workers: int = 4):
+		self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='observer')
+		self.queues = {}  # observer -> ObserverQueue
+		self.lock = threading.Lock()
+		self.idle = threading.Condition(self.lock)
+		self.closed = False
+
+	def submit(self, observer: Observer, payload):
+		with self.lock:
+			if self.closed:
+				raise RuntimeError('Dispatcher is closed')
+			queue = self.queues.get(observer)
+			if queue is None:
+				queue = self.queues[observer] = ObserverQueue(observer)
+			queue.pending.append((monotonic(), payload))
+			if queue.running:
+				return
+			queue.running = True
+		self.executor.submit(self._drain, queue)
+
+	def _drain(self, queue: ObserverQueue):
+		while True:
+			with self.lock:
+				if not queue.pending:
+					queue.running = False
+					self.idle.notify_all()
+					return
+				enqueued, payload = queue.pending.popleft()
+
+			lag = monotonic() - enqueued
+			queue.last_lag = lag
+			queue.max_lag = max(queue.max_lag, lag)
+			try:
+				queue.observer.update(payload)
+			except Exception as e:
+				queue.errors += 1
+				logger.exception(f'{type(queue.observer).__name__}.update failed: {e}')
+			queue.delivered += 1
+
+	def lag(self) -> dict:
+		now = monotonic()
+		with self.lock:
+			return {observer: {'pending': len(queue.pending),
+							   'oldest': now - queue.pending[0][0] if queue.pending else 0.0,
+							   'last_lag': queue.last_lag,
+							   'max_lag': queue.max_lag,
+							   'delivered': queue.delivered,
+							   'errors': queue.errors}
+					for observer, queue in self.queues.items()}
+
+	def forget(self, observer: Observer):
+		with self.lock:
+			queue = self.queues.get(observer)
+			if queue is not None and not queue.pending and not queue.running:
+				del self.queues[observer]
+
+	def flush(self, timeout: float = None) -> bool:
+		deadline = None if timeout is None else monotonic() + timeout
+		with self.lock:
+			while any(queue.pending or queue.running for queue in self.queues.values()):
+				remaining = None if deadline is None else deadline - monotonic()
+				if remaining is not None and remaining <= 0:
+					return False
+				self.idle.wait(remaining)
+		return True
+
+	def close(self, timeout: float = None) -> bool:
+		flushed = self.flush(timeout)
+		with self.lock:
+			self.closed = True
+		self.executor.shutdown(wait=flushed)
+		if not flushed:
+			logger.warning(f'Observers still had {sum(len(queue.pending) for queue in self.queues.values())} '
+						   f'notifications pending at shutdown')
+		return flushed
+
+
 class Observable:
-	def __init__(self):
-		self.observers = set()
+	# Notifications go through `dispatcher` when set, else `default_dispatcher`, else are delivered inline
+	default_dispatcher = None
+	dispatcher = None
+
+	def __init__(self, dispatcher: AsyncDispatcher = None):
+		self.observers = {}  # Used as an insertion-ordered set
+		self.dispatcher = dispatcher
 
 	def add_observer(self, observer: Observer):
-		self.observers.add(observer)
+		self.observers[observer] = None
 
 	def remove_observer(self, observer: Observer):
-		self.observers.remove(observer)
+		del self.observers[observer]
+		dispatcher = self.dispatcher or Observable.default_dispatcher
+		if dispatcher is not None:
+			dispatcher.forget(observer)
 
 	@staticmethod
 	def notify_observer(observer: Observer, payload):
 		observer.update(payload)
 
 	def notify_observers(self, payload):
-		[self.notify_observer(observer, payload) for observer in self.observers]
+		dispatcher = self.dispatcher or Observable.default_dispatcher
+		if dispatcher is None:
+			for observer in self.observers:
+				self.notify_observer(observer, payload)
+		else:
+			for observer in self.observers:
+				dispatcher.submit(observer, payload)
@@ -1,36 +1,145 @@
+import numpy as np
 import pandas as pd
 from datetime import datetime
+from loguru import logger
+from payload import DROPPED
+
+DROPPED_ELEMENTS = DROPPED.labels('malformed_element')
 
 
 class CategoryParser:
+    FIELDS = ()  # Keys copied from each element's value; empty when the value itself is stored as 'value'
+    # Compact column types: timestamps are datetime64[ns, UTC], values use the narrowest type that fits them.
+    # `element_dtypes` overrides them per element, e.g. int16 for a sensor that only reports integers.
+    DTYPES = {'value': 'float32'}
+
+    def __init__(self):
+        self.element_dtypes = {}  # element -> {column: dtype}
+
     def parse(self, category: dict, time=None) -> dict:
         if time is None:
             time = datetime.now()
 
-        elements = dict()
+        return self.parse_batch([category], [time])
+
+    def parse_batch(self, categories: list, times: list) -> dict:
+        columns = {}  # element -> {column: [values]}
+        fields = self.FIELDS or ('value',)
+
+        for category, time in zip(categories, times):
+            for element, value in category.items():
+                try:
+                    row = self.get_row(value)
+                except (KeyError, TypeError, IndexError) as e:
+                    # Only this element is dropped, not the other rows of the batch (other payloads, devices)
+                    DROPPED_ELEMENTS.inc()
+                    logger.warning(f'Dropping malformed {element}: {value!r}; {type(e).__name__}: {e}')
+                    continue
+                element_columns = columns.get(element)
+                if element_columns is None:
+                    element_columns = columns[element] = {column: [] for column in self.columns()}
+                element_columns['datetime'].append(time)
+                for column, cell in zip(fields, row):
+                    element_columns[column].append(cell)
 
-        for element, value in category.items():
-            df = self.get_df(value, time)
-            elements[element] = df
+        return {element: self.frame(element, element_columns) for element, element_columns in columns.items()}
 
-        return elements
+    def frame(self, element, columns: dict) -> pd.DataFrame:
+        dtypes = self.dtypes(element)
+        return pd.DataFrame({column: self.typed(values, dtypes.get(column)) if column != 'datetime'
+                             else pd.to_datetime(values, utc=True)
+                             for column, values in columns.items()})
+
+    def coerce(self, element, frame: pd.DataFrame) -> pd.DataFrame:
+        # Applies the schema to rows loaded from storage or replayed from the log; a no-op on parsed rows
+        dtypes = self.dtypes(element)
+        changes = {}
+        if 'datetime' in frame and str(getattr(frame['datetime'].dtype, 'tz', None)) != 'UTC':
+            changes['datetime'] = pd.to_datetime(frame['datetime'], utc=True)
+        for column, dtype in dtypes.items():
+            if column in frame and frame[column].dtype != dtype:
+                changes[column] = self.typed(frame[column].to_numpy(), dtype)
+        return frame.assign(**changes) if changes else frame
+
+    def dtypes(self, element) -> dict:
+        overrides = self.element_dtypes.get(element)
+        return dict(self.DTYPES, **overrides) if overrides else self.DTYPES
 
     @staticmethod
-    def get_df(value, time: datetime) -> pd.DataFrame:
-        return pd.DataFrame.from_dict({'datetime': [time], 'value': [value]})
+    def typed(values, dtype):
+        # Values that do not fit (missing ones in an int or bool column, out of range, strings...) keep their
+        # inferred type; missing floats become NaN
+        if dtype is None:
+            return values
+        kind = np.dtype(dtype).kind
+        try:
+            array = np.asarray(values)
+            if array.dtype == object:
+                missing = np.equal(array, None)
+                if missing.any():
+                    if kind != 'f':
+                        return values
+                    array = np.where(missing, np.nan, array)
+            typed = array.astype(dtype)
+        except (TypeError, ValueError):
+            return values
+        if kind in 'iub' and array.dtype.kind != 'b' and not np.array_equal(typed, array):
+            return values
+        return typed
+
+    def columns(self) -> list:
+        return ['datetime', *(self.FIELDS or ('value',))]
+
+    def get_row(self, value) -> tuple:
+        if not self.FIELDS:
+            return value,
+        return tuple(value[field] for field in self.FIELDS)
+
+    def get_df(self, value, time: datetime) -> pd.DataFrame:
+        return self.parse_batch([{None: value}], [time])[None]
 
 
 class ActuatorsParser (CategoryParser):
-    @staticmethod
-    def get_df(value, time: datetime) -> pd.DataFrame:
-        return pd.DataFrame.from_dict({'datetime': [time],
-                                       'available': [value['available']]})
+    FIELDS = ('available',)
+    DTYPES = {'available': 'bool'}
 
 
 class ControllersParser (CategoryParser):
-    @staticmethod
-    def get_df(value, time: datetime) -> pd.DataFrame:
-        return pd.DataFrame.from_dict({'datetime': [time],
-                                       'enabled': [value['enabled']],
-                                       'busy': [value['busy']]})
+    FIELDS = ('enabled', 'busy')
+    DTYPES = {'enabled': 'bool', 'busy': 'bool'}
+
+
+PARSERS = {'sensors': CategoryParser(),
+           'actuators': ActuatorsParser(),
+           'controllers': ControllersParser()}
+
+_unknown_categories = set()
+
+
+def configure(dtypes: dict):
+    # BACKEND.dtypes: {category: {element: dtype of its 'value' or {column: dtype}}}
+    for category, elements in (dtypes or {}).items():
+        parser = get_parser(category)
+        if parser is None:
+            continue
+        for element, dtype in elements.items():
+            parser.element_dtypes[element] = dtype if isinstance(dtype, dict) else {'value': dtype}
+
+
+def widen(frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    float32 is for memory only: before rows leave the process (database, log) each float32 value becomes
+    the float64 of its shortest decimal form, so 23.45 is written as 23.45 and not 23.450000762939453.
+    """
+    columns = [column for column in frame.columns if frame[column].dtype == np.float32]
+    if not columns:
+        return frame
+    return frame.assign(**{column: frame[column].to_numpy().astype(str).astype(np.float64) for column in columns})
+
 
+def get_parser(category: str):
+    parser = PARSERS.get(category)
+    if parser is None and category not in _unknown_categories:
+        _unknown_categories.add(category)
+        logger.warning(f'No parser for category "{category}", its data will be ignored')
+    return parser
@@ -0,0 +1,121 @@
+import json
+import re
+from datetime import datetime, timezone
+from functools import lru_cache
+from loguru import logger
+from metrics import Counter
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+CATEGORIES = ('sensors', 'actuators', 'controllers')
+DEFAULT_DEVICE = 'default'
+UNSAFE_DEVICE_CHARACTERS = re.compile(r'[^A-Za-z0-9_-]')
+DATETIME_FORMAT = '%Y-%m-%d_%H-%M-%S'
+KNOWN_KEYS = frozenset(('datetime', 'timestamp', 'device', *CATEGORIES))
+# Device ids stored as DEFAULT_DEVICE, see `configure`
+DEFAULT_DEVICE_IDS = set()
+# MicroPython boards count seconds from 2000-01-01: no Unix timestamp of a live sample is that small.
+EMBEDDED_EPOCH_OFFSET = 946684800
+
+DROPPED = Counter('greenhouse_messages_dropped', 'Messages dropped before reaching storage', ('reason',))
+DROPPED_INVALID = DROPPED.labels('invalid')
+
+
+class PayloadError(ValueError):
+    pass
+
+
+@lru_cache(maxsize=4096)
+def parse_datetime(value: str) -> datetime:
+    # Fixed width 'YYYY-mm-dd_HH-MM-SS': slicing is several times faster than strptime
+    if len(value) == 19 and value[4] == value[7] == '-' and value[10] == '_' and value[13] == value[16] == '-':
+        try:
+            return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                            int(value[11:13]), int(value[14:16]), int(value[17:19]), tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    return datetime.strptime(value, DATETIME_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def parse_timestamp(value: float) -> datetime:
+    if value < EMBEDDED_EPOCH_OFFSET:
+        value += EMBEDDED_EPOCH_OFFSET
+    return datetime.fromtimestamp(value, timezone.utc)
+
+
+def device_from_topic(topic: str, level: int = None):
+    # e.g. level 1 of 'greenhouse/<device_id>/telemetry'
+    if level is None:
+        return None
+    levels = topic.split('/')
+    return levels[level] if len(levels) > level else None
+
+
+def decode(message, device: str = None) -> dict:
+    """
+    Decodes and validates a device message in a single pass. Both the 'datetime' string and the
+    'timestamp' number sent by the ESP32 are accepted; either way the result carries the sample time
+    as an aware datetime under 'datetime'. The device is the payload's 'device', else `device` (usually
+    taken from the topic), else DEFAULT_DEVICE.
+    """
+    try:
+        payload = loads(message)
+    except ValueError as e:
+        raise PayloadError(f'Invalid JSON: {e}')
+
+    if type(payload) is not dict:
+        raise PayloadError(f'Expected a JSON object, got {type(payload).__name__}')
+
+    if 'datetime' in payload:
+        time = payload['datetime']
+        if type(time) is not str:
+            raise PayloadError(f'"datetime" must be a string, got {time!r}')
+        try:
+            time = parse_datetime(time)
+        except ValueError as e:
+            raise PayloadError(f'Invalid "datetime": {e}')
+    elif 'timestamp' in payload:
+        time = payload['timestamp']
+        if type(time) not in (int, float):
+            raise PayloadError(f'"timestamp" must be a number, got {time!r}')
+        time = parse_timestamp(time)
+    else:
+        raise PayloadError('Missing "datetime" or "timestamp"')
+
+    unknown = payload.keys() - KNOWN_KEYS
+    if unknown:
+        raise PayloadError(f'Unknown keys: {sorted(unknown)}')
+
+    device = payload.get('device', device) or DEFAULT_DEVICE
+    if type(device) is not str:
+        raise PayloadError(f'"device" must be a string, got {device!r}')
+    if device in DEFAULT_DEVICE_IDS:
+        device = DEFAULT_DEVICE
+
+    decoded = {'datetime': time, 'device': UNSAFE_DEVICE_CHARACTERS.sub('_', device)}
+    for category in CATEGORIES:
+        values = payload.get(category)
+        if type(values) is not dict:
+            raise PayloadError(f'"{category}" must be an object, got {values!r}')
+        decoded[category] = values
+
+    return decoded
+
+
+def configure(default_device_ids):
+    # BACKEND.default_device_ids: devices whose rows keep going to the single-device data_path and tables
+    DEFAULT_DEVICE_IDS.clear()
+    DEFAULT_DEVICE_IDS.update(str(device) for device in default_device_ids or ())
+
+
+def try_decode(message, device: str = None):
+    try:
+        return decode(message, device)
+    except PayloadError as e:
+        DROPPED_INVALID.inc()
+        logger.warning(f'Dropping payload; {e}')
+        return None
@@ -0,0 +1,181 @@
+import threading
+from collections import deque
+from loguru import logger
+
+
+class BoundedQueue:
+    """
+    Queue of (key, [items]) entries holding at most `maxsize` entries. When it is full `put`:
+        - 'block': waits for a free slot;
+        - 'drop_oldest': evicts the oldest entry;
+        - 'coalesce': appends the item to the entry already queued for the same key (so every item is
+          still delivered, batched per key), blocking only if the key has nothing queued or its entry already
+          holds `max_coalesced` items. At most `maxsize` * `max_coalesced` items are ever queued.
+    """
+    POLICIES = ('block', 'drop_oldest', 'coalesce')
+
+    def __init__(self, maxsize: int = 1000, policy: str = 'block', max_coalesced: int = 100):
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown backpressure policy "{policy}", expected one of {self.POLICIES}')
+        self.maxsize = maxsize
+        self.policy = policy
+        self.max_coalesced = max_coalesced
+        self._entries = deque()
+        self._queued = {}  # key -> last queued entry, used by 'coalesce'
+        self._unfinished = 0
+        self.mutex = threading.Lock()
+        self._not_empty = threading.Condition(self.mutex)
+        self._not_full = threading.Condition(self.mutex)
+        self._all_done = threading.Condition(self.mutex)
+        self.puts = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, key, item):
+        with self.mutex:
+            self.puts += 1
+            full = len(self._entries) >= self.maxsize
+
+            if full and self.policy == 'coalesce':
+                entry = self._queued.get(key)
+                if entry is not None and len(entry[1]) < self.max_coalesced:
+                    entry[1].append(item)
+                    self.coalesced += 1
+                    return
+
+            if self.policy == 'drop_oldest':
+                while len(self._entries) >= self.maxsize:
+                    self._discard(self._entries.popleft())
+            else:
+                while len(self._entries) >= self.maxsize:
+                    self._not_full.wait()
+
+            entry = (key, [item])
+            self._entries.append(entry)
+            self._queued[key] = entry
+            self._unfinished += 1
+            self.max_depth = max(self.max_depth, len(self._entries))
+            self._not_empty.notify()
+
+    def get(self, timeout: float = None):
+        entries = self.get_many(1, timeout)
+        return entries[0] if entries else None
+
+    def get_many(self, limit: int, timeout: float = None) -> list:
+        with self.mutex:
+            if not self._entries:
+                self._not_empty.wait(timeout)
+
+            entries = []
+            while self._entries and len(entries) < limit:
+                entry = self._entries.popleft()
+                if self._queued.get(entry[0]) is entry:
+                    del self._queued[entry[0]]
+                entries.append(entry)
+            self._not_full.notify(len(entries))
+            return entries
+
+    def task_done(self):
+        with self.mutex:
+            self._unfinished -= 1
+            if self._unfinished == 0:
+                self._all_done.notify_all()
+
+    def join(self):
+        with self.mutex:
+            while self._unfinished:
+                self._all_done.wait()
+
+    def _discard(self, entry):
+        if self._queued.get(entry[0]) is entry:
+            del self._queued[entry[0]]
+        self.dropped += len(entry[1])
+        self._unfinished -= 1
+        if self._unfinished == 0:
+            self._all_done.notify_all()
+
+
+class IngestPipeline:
+    """
+    Runs `stages`, a list of (name, function[, batch]) tuples, on worker threads connected by bounded
+    queues. Each function receives the previous stage's result and returns None to stop an item there;
+    batch stages receive instead a list with every item queued (up to `batch_size` entries) and return
+    a single result.
+    The backpressure policy applies to the first queue only, the following ones block and so push the
+    pressure back to it. A 'coalesce' entry holds at most `batch_size` items, so the queued items stay bounded.
+    """
+
+    def __init__(self, stages: list, maxsize: int = 1000, policy: str = 'block', workers: int = 1,
+                 batch_size: int = 100):
+        self.stages = [(stage[0], stage[1], stage[2] if len(stage) > 2 else False) for stage in stages]
+        self.batch_size = batch_size
+        self.queues = [BoundedQueue(maxsize, policy, batch_size)] + [BoundedQueue(maxsize) for _ in stages[1:]]
+        self.processed = {name: 0 for name, _, _ in self.stages}
+        self.errors = {name: 0 for name, _, _ in self.stages}
+        self._counters_lock = threading.Lock()  # the `workers` threads of a stage share its counters
+        self._stop = threading.Event()
+        self._threads = [threading.Thread(target=self._work, args=(index,), name=f'ingest-{name}-{n}', daemon=True)
+                         for index, (name, _, _) in enumerate(self.stages)
+                         for n in range(workers)]
+        [thread.start() for thread in self._threads]
+
+    def put(self, key, item):
+        self.queues[0].put(key, item)
+
+    def drain(self):
+        [queue.join() for queue in self.queues]
+
+    def close(self):
+        logger.info('Draining ingest pipeline...')
+        self.drain()
+        self._stop.set()
+        [thread.join() for thread in self._threads]
+        logger.info(f'Ingest pipeline closed: {self.metrics()}')
+
+    def metrics(self) -> dict:
+        with self._counters_lock:
+            processed, errors = dict(self.processed), dict(self.errors)
+        return {name: {'depth': len(queue),
+                       'max_depth': queue.max_depth,
+                       'received': queue.puts,
+                       'dropped': queue.dropped,
+                       'coalesced': queue.coalesced,
+                       'processed': processed[name],
+                       'errors': errors[name]}
+                for (name, _, _), queue in zip(self.stages, self.queues)}
+
+    def _work(self, index: int):
+        name, function, batch = self.stages[index]
+        queue = self.queues[index]
+        next_queue = self.queues[index + 1] if index + 1 < len(self.queues) else None
+
+        while not self._stop.is_set():
+            entries = queue.get_many(self.batch_size if batch else 1, timeout=0.5)
+            try:
+                if batch and entries:
+                    key = entries[-1][0]
+                    calls = [(key, [item for _, items in entries for item in items])]
+                else:
+                    calls = [(key, item) for key, items in entries for item in items]
+
+                for key, item in calls:
+                    try:
+                        result = function(item)
+                    except Exception as e:
+                        with self._counters_lock:
+                            self.errors[name] += 1
+                        logger.exception(f'Stage "{name}" failed on {key}: {e}')
+                        continue
+
+                    with self._counters_lock:
+                        self.processed[name] += len(item) if batch else 1
+                    if result is None:
+                        continue
+                    if next_queue is not None:
+                        next_queue.put(key, result)
+            finally:
+                [queue.task_done() for _ in entries]
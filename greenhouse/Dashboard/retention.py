@@ -0,0 +1,74 @@
+import threading
+from datetime import datetime, timedelta, timezone
+from loguru import logger
+from metrics import Counter
+
+ROWS_TRIMMED = Counter('greenhouse_retention_rows_trimmed', 'Rows dropped from memory by the retention policy')
+ROWS_ARCHIVED = Counter('greenhouse_retention_rows_archived', 'Rows moved from storage to the archive')
+
+DEFAULT_POLICY = {'memory_hours': 168,
+                  'rollup_days': {'1min': 7, '1h': 365, '1d': None},
+                  'disk_days': None}
+
+
+def policy(config: dict, category: str) -> dict:
+    # RETENTION.default, overridden key by key by RETENTION.<category>
+    merged = dict(DEFAULT_POLICY, **config.get('default', {}))
+    merged.update(config.get(category, {}))
+    return merged
+
+
+def cutoffs(category_policy: dict, now: datetime) -> tuple:
+    # (memory, {resolution: rollup}, disk) cutoff times, None where nothing expires
+    memory_hours = category_policy.get('memory_hours')
+    disk_days = category_policy.get('disk_days')
+    rollup_days = category_policy.get('rollup_days') or {}
+    return (now - timedelta(hours=memory_hours) if memory_hours is not None else None,
+            {resolution: now - timedelta(days=days) for resolution, days in rollup_days.items() if days is not None},
+            now - timedelta(days=disk_days) if disk_days is not None else None)
+
+
+class RetentionTask:
+    """
+    Enforces the RETENTION settings every `interval` seconds on every shard of `backend`: raw rows older
+    than `memory_hours` are trimmed from the things in place (they stay readable from storage), rollup
+    buckets older than `rollup_days[resolution]` are dropped, and rows stored for more than `disk_days`
+    are moved to compressed files under `archive_path`. A None retention keeps everything.
+    """
+
+    def __init__(self, backend, config: dict):
+        self.backend = backend
+        self.config = config
+        self.interval = config.get('interval', 3600)
+        self.archive_path = config.get('archive_path', './archive')
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name='retention', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def run(self, now: datetime = None) -> dict:
+        now = now or datetime.now(timezone.utc)
+        totals = {'rows_trimmed': 0, 'buckets_trimmed': 0, 'rows_archived': 0}
+        for shard in list(self.backend.shards.values()):
+            stats = shard.expire(lambda category: cutoffs(policy(self.config, category), now),
+                                 shard.archive_path(self.archive_path))
+            for key, value in stats.items():
+                totals[key] += value
+
+        ROWS_TRIMMED.inc(totals['rows_trimmed'])
+        ROWS_ARCHIVED.inc(totals['rows_archived'])
+        logger.info(f'Retention: {totals}')
+        return totals
+
+    def close(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run()
+            except Exception as e:
+                logger.exception(f'Retention failed: {e}')
@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from threading import Lock
+
+DEFAULT_RESOLUTIONS = ('1min', '1h', '1d')
+
+
+def epoch_seconds(times: pd.Series) -> np.ndarray:
+    if isinstance(getattr(times, 'dtype', None), pd.DatetimeTZDtype):
+        # Timezone-aware times are held as UTC datetime64, so no parsing or conversion is needed
+        return times.values.astype('datetime64[s]').astype(np.int64)
+    return pd.to_datetime(times, utc=True).to_numpy(dtype='datetime64[s]').astype(np.int64)
+
+
+def aggregate(frame: pd.DataFrame, resolution: int) -> pd.DataFrame:
+    columns = numeric_columns(frame)
+    buckets = epoch_seconds(frame['datetime']) // resolution * resolution
+    grouped = frame[columns].astype(float).groupby(buckets).agg(['count', 'sum', 'min', 'max'])
+    result = pd.DataFrame({'datetime': pd.to_datetime(grouped.index, unit='s', utc=True)})
+    for column in columns:
+        result[f'{column}_min'] = grouped[(column, 'min')].to_numpy()
+        result[f'{column}_max'] = grouped[(column, 'max')].to_numpy()
+        result[f'{column}_mean'] = (grouped[(column, 'sum')] / grouped[(column, 'count')]).to_numpy()
+    return result
+
+
+def numeric_columns(frame: pd.DataFrame) -> list:
+    return [column for column in frame.columns
+            if column != 'datetime' and (pd.api.types.is_numeric_dtype(frame[column])
+                                         or pd.api.types.is_bool_dtype(frame[column]))]
+
+
+def frame_values(frame: pd.DataFrame, columns: list) -> list:
+    return np.column_stack([frame[column].to_numpy(dtype=float) for column in columns]).tolist()
+
+
+class Rollup:
+    """
+    Streaming count/sum/min/max of every numeric column over `resolution` seconds buckets. Each row
+    updates its bucket in O(1); booleans are counted as 0/1, so their mean is a duty cycle.
+    """
+
+    def __init__(self, resolution: str):
+        self.name = resolution
+        self.resolution = int(pd.Timedelta(resolution).total_seconds())
+        self.buckets = {}  # bucket start (epoch seconds) -> {column: [count, sum, min, max]}
+        # Buckets are complete from this epoch on (the data loaded or retained), None if from the beginning
+        self.covered_from = None
+        self.mutex = Lock()
+
+    def add(self, frame: pd.DataFrame):
+        columns = numeric_columns(frame)
+        if not columns or not len(frame):
+            return
+        self.add_rows(epoch_seconds(frame['datetime']).tolist(), columns, frame_values(frame, columns))
+
+    def add_rows(self, seconds: list, columns: list, rows: list):
+        # `seconds` epoch of each row, `rows` its float values in `columns` order, as plain lists
+        resolution = self.resolution
+        with self.mutex:
+            for second, row in zip(seconds, rows):
+                bucket = second - second % resolution
+                stats = self.buckets.get(bucket)
+                if stats is None:
+                    stats = self.buckets[bucket] = {}
+                for column, value in zip(columns, row):
+                    if value != value:  # NaN
+                        continue
+                    column_stats = stats.get(column)
+                    if column_stats is None:
+                        stats[column] = [1, value, value, value]
+                    else:
+                        column_stats[0] += 1
+                        column_stats[1] += value
+                        if value < column_stats[2]:
+                            column_stats[2] = value
+                        if value > column_stats[3]:
+                            column_stats[3] = value
+
+    def rebuild(self, frame: pd.DataFrame):
+        buckets = {}
+        columns = numeric_columns(frame)
+        if len(frame) and columns:
+            keys = epoch_seconds(frame['datetime']) // self.resolution * self.resolution
+            grouped = frame[columns].astype(float).groupby(keys).agg(['count', 'sum', 'min', 'max'])
+            for bucket, row in zip(grouped.index.tolist(), grouped.to_numpy().tolist()):
+                buckets[bucket] = {column: row[4 * i:4 * i + 4] for i, column in enumerate(columns)}
+
+        with self.mutex:
+            self.buckets = buckets
+
+    def trim(self, before: int) -> int:
+        cutoff = before - before % self.resolution
+        with self.mutex:
+            expired = [bucket for bucket in self.buckets if bucket < cutoff]
+            for bucket in expired:
+                del self.buckets[bucket]
+            self.covered_from = cutoff if self.covered_from is None else max(self.covered_from, cutoff)
+        return len(expired)
+
+    def covers(self, start: int = None) -> bool:
+        return self.covered_from is None or (start is not None and start >= self.covered_from)
+
+    def buckets_between(self, start: int = None, end: int = None) -> int:
+        if start is None or end is None:
+            return len(self.buckets)
+        return (end - start) // self.resolution + 1
+
+    def frame(self, start: int = None, end: int = None) -> pd.DataFrame:
+        with self.mutex:
+            selected = sorted((bucket, stats) for bucket, stats in self.buckets.items()
+                              if (start is None or bucket >= start - start % self.resolution)
+                              and (end is None or bucket < end))
+
+        rows = []
+        for bucket, stats in selected:
+            row = {'datetime': bucket}
+            for column, (count, total, minimum, maximum) in stats.items():
+                row[f'{column}_min'] = minimum
+                row[f'{column}_max'] = maximum
+                row[f'{column}_mean'] = total / count if count else np.nan
+            rows.append(row)
+
+        result = pd.DataFrame(rows)
+        if len(result):
+            result['datetime'] = pd.to_datetime(result['datetime'], unit='s', utc=True)
+        return result
+
+
+class Rollups:
+    def __init__(self, resolutions=DEFAULT_RESOLUTIONS):
+        self.rollups = sorted((Rollup(resolution) for resolution in resolutions), key=lambda r: r.resolution)
+
+    def add(self, frame: pd.DataFrame):
+        # The bucket keys and values are extracted once for all the resolutions
+        columns = numeric_columns(frame)
+        if not columns or not len(frame) or not self.rollups:
+            return
+        seconds = epoch_seconds(frame['datetime']).tolist()
+        rows = frame_values(frame, columns)
+        [rollup.add_rows(seconds, columns, rows) for rollup in self.rollups]
+
+    def rebuild(self, frame: pd.DataFrame):
+        [rollup.rebuild(frame) for rollup in self.rollups]
+
+    def cover_from(self, start: datetime):
+        for rollup in self.rollups:
+            rollup.covered_from = int(pd.Timestamp(start).timestamp()) if start is not None else None
+
+    def trim(self, cutoffs: dict) -> int:
+        # {resolution name: datetime}, resolutions missing or mapped to None are kept whole
+        trimmed = 0
+        for rollup in self.rollups:
+            cutoff = cutoffs.get(rollup.name)
+            if cutoff is not None:
+                trimmed += rollup.trim(int(pd.Timestamp(cutoff).timestamp()))
+        return trimmed
+
+    def pick(self, start: datetime, end: datetime, max_points: int):
+        # The finest resolution whose bucket count fits in the budget: data is only coarsened as much as needed
+        start, end = self.bounds(start, end)
+        for rollup in self.rollups:
+            if rollup.buckets_between(start, end) <= max_points:
+                return rollup
+        return self.rollups[-1] if self.rollups else None
+
+    def query(self, start: datetime = None, end: datetime = None, max_points: int = 1000) -> pd.DataFrame:
+        rollup = self.pick(start, end, max_points)
+        if rollup is None:
+            return pd.DataFrame()
+        return rollup.frame(*self.bounds(start, end))
+
+    @staticmethod
+    def bounds(start: datetime, end: datetime) -> tuple:
+        return (int(pd.Timestamp(start).timestamp()) if start is not None else None,
+                int(pd.Timestamp(end).timestamp()) if end is not None else None)
@@ -0,0 +1,58 @@
+import threading
+from time import monotonic
+from loguru import logger
+
+
+class Scheduler:
+    """
+    One thread running the delayed calls of every shard, e.g. the storage flushes or the log syncs of
+    hundreds of devices. A call is identified by its (owner, name): scheduling it again before it ran
+    keeps the earlier due time. With nothing due the thread sleeps until something is scheduled, so an
+    idle process does not wake up. Calls run one after the other and should not block for long.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}  # (owner, name) -> (due, function)
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def call_later(self, owner, name: str, delay: float, function):
+        due = monotonic() + delay
+        with self._condition:
+            scheduled = self._calls.get((owner, name))
+            if scheduled is not None and scheduled[0] <= due:
+                return
+            self._calls[(owner, name)] = (due, function)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def cancel(self, owner):
+        # A call of `owner` already running is not interrupted
+        with self._condition:
+            for key in [key for key in self._calls if key[0] is owner]:
+                del self._calls[key]
+
+    def pending(self) -> int:
+        return len(self._calls)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = monotonic()
+                    due = sorted((when, index, key) for index, (key, (when, _)) in enumerate(self._calls.items())
+                                 if when <= now)
+                    if due:
+                        break
+                    timeout = min(when for when, _ in self._calls.values()) - now if self._calls else None
+                    self._condition.wait(timeout)
+                calls = [(key, self._calls.pop(key)[1]) for _, _, key in due]
+
+            for (owner, name), function in calls:
+                try:
+                    function()
+                except Exception as e:
+                    logger.exception(f'{self.name}: {name} of {owner.__class__.__name__} failed: {e}')
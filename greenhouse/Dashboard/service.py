@@ -0,0 +1,56 @@
+import os
+import signal
+import threading
+from time import perf_counter
+from loguru import logger
+
+SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)
+
+
+class Service:
+    """
+    Keeps a long running entry point idle, blocked without polling, until SIGTERM, SIGINT or SIGHUP.
+    It then runs the shutdown `steps`, (name, callable) pairs, in order and logs how long each took.
+    A second signal during the shutdown exits at once.
+    """
+
+    def __init__(self, name: str, steps: list):
+        self.name = name
+        self.steps = list(steps)
+        self._stop = threading.Event()
+
+    def install(self):
+        # Signal handlers can only be set from the main thread
+        [signal.signal(signum, self._on_signal) for signum in SIGNALS]
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self) -> dict:
+        self.install()
+        logger.success(f'{self.name} running, waiting for a stop signal.')
+        self._stop.wait()
+        return self.shutdown()
+
+    def shutdown(self) -> dict:
+        logger.info(f'Stopping {self.name}...')
+        timings = {}
+        start = perf_counter()
+        for name, step in self.steps:
+            step_start = perf_counter()
+            try:
+                step()
+            except Exception as e:
+                logger.exception(f'Shutdown step "{name}" failed: {e}')
+            timings[name] = perf_counter() - step_start
+            logger.info(f'Shutdown step "{name}" took {timings[name]:.3f}s')
+        timings['total'] = perf_counter() - start
+        logger.success(f'{self.name} stopped in {timings["total"]:.3f}s.')
+        return timings
+
+    def _on_signal(self, signum, frame):
+        if self._stop.is_set():
+            logger.warning(f'{signal.Signals(signum).name} received again, exiting without finishing the shutdown')
+            os._exit(1)
+        logger.info(f'{signal.Signals(signum).name} received')
+        self._stop.set()
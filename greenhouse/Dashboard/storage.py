@@ -0,0 +1,462 @@
+import gzip
+import os.path
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from itertools import count
+import pandas as pd
+from loguru import logger
+from scheduler import Scheduler
+
+# Runs the timed flushes and compactions of the storages of every shard
+FLUSHER = Scheduler('storage-flush')
+
+
+def to_utc(times: pd.Series) -> pd.Series:
+    return pd.to_datetime(times, utc=True)
+
+
+def to_timestamp(time: datetime) -> pd.Timestamp:
+    time = pd.Timestamp(time)
+    return time.tz_localize('UTC') if time.tz is None else time
+
+
+def fsync_file(path: str):
+    with open(path, 'rb') as file:
+        os.fsync(file.fileno())
+
+
+def fsync_directory(path: str):
+    # Makes the renames and removals in `path` durable
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def earliest(time, other):
+    # Either may be None or NaT (no rows)
+    if time is None or pd.isna(time):
+        return None if pd.isna(other) else other
+    return time if pd.isna(other) else min(time, other)
+
+
+def select(frame: pd.DataFrame, start: datetime = None, end: datetime = None) -> pd.DataFrame:
+    if (start is None and end is None) or 'datetime' not in frame:
+        return frame
+
+    times = to_utc(frame['datetime'])
+    mask = pd.Series(True, index=frame.index)
+    if start is not None:
+        mask &= times >= to_timestamp(start)
+    if end is not None:
+        mask &= times < to_timestamp(end)
+    return frame[mask]
+
+
+class BufferedWriter:
+    """
+    Buffers appended rows in memory and writes them once `flush_rows` rows are pending or
+    `flush_interval` seconds after the first pending row, whichever comes first; the timed flushes of
+    all storages run on the shared FLUSHER thread. A flush hands the rows to the OS but does not fsync,
+    so a crash loses at most the rows buffered since the last flush: lower values shorten that window at
+    the cost of more (smaller) writes per sample, `flush_rows: 1` writes through on every sample.
+    """
+
+    def __init__(self, root: str, flush_rows: int = 100, flush_interval: float = 5.0):
+        self.root = root
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._pending = {}  # (sub_path, name) -> [DataFrame]
+        self._pending_rows = 0
+        self._lock = threading.Lock()
+
+    def append(self, sub_path: str, name: str, rows: pd.DataFrame):
+        with self._lock:
+            first = not self._pending_rows
+            self._pending.setdefault((sub_path, name), []).append(rows)
+            self._pending_rows += len(rows)
+            if self._pending_rows >= self.flush_rows:
+                self._flush()
+                return
+        if first:
+            FLUSHER.call_later(self, 'flush', self.flush_interval, self.flush)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def sync(self):
+        """Fsyncs what the flushes wrote so far, e.g. before the write-ahead log drops its copy of the rows."""
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        FLUSHER.cancel(self)
+        with self._lock:
+            self._flush()
+            self._close()
+
+    def things(self) -> list:
+        raise NotImplementedError
+
+    def read(self, sub_path: str, name: str, start: datetime = None, end: datetime = None) -> pd.DataFrame:
+        raise NotImplementedError
+
+    def expire(self, sub_path: str, name: str, before: datetime, archive: str) -> int:
+        """Moves the rows older than `before` to compressed files under `archive`, returns how many were moved."""
+        raise NotImplementedError
+
+    def _flush(self):
+        if not self._pending_rows:
+            return
+
+        logger.debug(f'Flushing {self._pending_rows} rows to {self.root}...')
+        for (sub_path, name), frames in self._pending.items():
+            self._write(sub_path, name, frames)
+
+        self._pending = {}
+        self._pending_rows = 0
+        logger.debug('Flushed.')
+
+    def _write(self, sub_path: str, name: str, frames: list):
+        raise NotImplementedError
+
+    def _sync(self):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+
+class OpenFiles:
+    """
+    Least recently used files of the SegmentWriters of every shard: once more than `limit` are open, the
+    oldest ones are closed, so the number of devices is not bounded by the file descriptor limit. Each
+    writer only touches its files under its own lock; a file of a writer that is busy flushing is skipped.
+    """
+
+    def __init__(self, limit: int = 256):
+        self.limit = limit
+        self._files = OrderedDict()  # (writer, key) -> None, least recently used first
+        self._lock = threading.Lock()
+
+    def use(self, writer, key: tuple):
+        # Called by `writer` under its lock
+        with self._lock:
+            self._files[(writer, key)] = None
+            self._files.move_to_end((writer, key))
+            excess = len(self._files) - self.limit
+            oldest = list(self._files)[:excess] if excess > 0 else []
+
+        for owner, owner_key in oldest:
+            if owner is writer:
+                if owner_key in owner._files:
+                    owner._close_file(owner_key)
+            elif owner._lock.acquire(blocking=False):
+                try:
+                    if owner_key in owner._files:
+                        owner._close_file(owner_key)
+                finally:
+                    owner._lock.release()
+
+    def remove(self, writer, key: tuple):
+        with self._lock:
+            self._files.pop((writer, key), None)
+
+
+OPEN_FILES = OpenFiles()
+
+
+class SegmentWriter(BufferedWriter):
+    """
+    Append-only CSV storage, one `<sub_path>/<name>.csv` per thing: only the rows received since the last
+    flush are appended to it. Files stay open between the flushes that write to them; the others are closed
+    at the end of each flush, and OPEN_FILES caps the files kept open by the writers of all shards.
+    """
+
+    def __init__(self, root: str, flush_rows: int = 100, flush_interval: float = 5.0):
+        self._files = {}  # (sub_path, name) -> (file, columns)
+        self._written = set()  # keys written by the current flush
+        self._created = set()  # directories of the files created since the last sync
+        self._unsynced = set()  # paths of the files closed since the last sync
+        # (sub_path, name) -> oldest row time (None when empty): late rows make it any row, not the first
+        self._oldest = {}
+        super().__init__(root, flush_rows, flush_interval)
+
+    def things(self) -> list:
+        if not os.path.isdir(self.root):
+            return []
+
+        return [(category, filename[:-len('.csv')])
+                for category in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, category))
+                for filename in os.listdir(os.path.join(self.root, category)) if filename.endswith('.csv')]
+
+    def read(self, sub_path: str, name: str, start: datetime = None, end: datetime = None,
+             chunk_rows: int = 100_000) -> pd.DataFrame:
+        filepath = os.path.join(self.root, sub_path, f'{name}.csv')
+        if start is None and end is None:
+            return pd.read_csv(filepath)
+
+        # Filtering chunk by chunk keeps only the selected rows in memory
+        chunks = [select(chunk, start, end) for chunk in pd.read_csv(filepath, chunksize=chunk_rows)]
+        return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+
+    def expire(self, sub_path: str, name: str, before: datetime, archive: str, chunk_rows: int = 100_000) -> int:
+        filepath = os.path.join(self.root, sub_path, f'{name}.csv')
+        before = to_timestamp(before)
+
+        # Appends wait while the file is rewritten: expired rows go to monthly archives, the others to a new file
+        with self._lock:
+            self._flush()
+            if not os.path.exists(filepath):
+                return 0
+            key = (sub_path, name)
+            oldest = self._oldest_time(key, filepath, chunk_rows)
+            if oldest is None or oldest >= before:
+                return 0
+            if key in self._files:
+                self._close_file(key)
+
+            expired = 0
+            header = True
+            oldest = None
+            with open(f'{filepath}.tmp', 'w', newline='') as kept:
+                for chunk in pd.read_csv(filepath, chunksize=chunk_rows):
+                    times = to_utc(chunk['datetime'])
+                    old = (times < before).to_numpy()
+                    for month, rows in chunk[old].groupby(times[old].dt.strftime('%Y-%m').to_numpy()):
+                        archive_csv(rows, os.path.join(archive, sub_path, name, f'{month}.csv.gz'))
+                    chunk[~old].to_csv(kept, header=header, index=False)
+                    header = False
+                    expired += int(old.sum())
+                    oldest = earliest(oldest, times[~old].min())
+                kept.flush()
+                os.fsync(kept.fileno())
+            os.replace(f'{filepath}.tmp', filepath)
+            fsync_directory(os.path.dirname(filepath))
+            self._oldest[key] = oldest
+
+        logger.debug(f'Archived {expired} rows of {sub_path}/{name} older than {before}')
+        return expired
+
+    def _oldest_time(self, key: tuple, filepath: str, chunk_rows: int):
+        # Scanned once per file, then kept up to date by `_write` and `expire`
+        if key not in self._oldest:
+            with open(filepath, 'r') as file:
+                header = file.readline().strip().split(',')
+            oldest = None
+            if 'datetime' in header:
+                for chunk in pd.read_csv(filepath, usecols=['datetime'], chunksize=chunk_rows):
+                    oldest = earliest(oldest, to_utc(chunk['datetime']).min())
+            self._oldest[key] = oldest
+        return self._oldest[key]
+
+    def _flush(self):
+        if not self._pending_rows:
+            return
+
+        super()._flush()
+        for key in [key for key in self._files if key not in self._written]:
+            self._close_file(key)
+        self._written = set()
+
+    def _write(self, sub_path: str, name: str, frames: list):
+        file, columns = self._open(sub_path, name, frames[0].columns)
+        for frame in frames:
+            frame.reindex(columns=columns).to_csv(file, header=False, index=False)
+        file.flush()
+        key = (sub_path, name)
+        self._written.add(key)
+        if key in self._oldest:
+            for frame in frames:
+                if 'datetime' in frame:
+                    self._oldest[key] = earliest(self._oldest[key], to_utc(frame['datetime']).min())
+
+    def _sync(self):
+        for file, _ in self._files.values():
+            os.fsync(file.fileno())
+        [fsync_file(path) for path in self._unsynced if os.path.exists(path)]
+        self._unsynced = set()
+        [fsync_directory(directory) for directory in self._created]
+        self._created = set()
+
+    def _close(self):
+        for key in list(self._files):
+            self._close_file(key)
+
+    def _close_file(self, key: tuple):
+        # Its rows are fsynced by the next sync, which reopens it
+        file, _ = self._files.pop(key)
+        file.close()
+        self._unsynced.add(file.name)
+        OPEN_FILES.remove(self, key)
+
+    def _open(self, sub_path: str, name: str, columns) -> tuple:
+        key = (sub_path, name)
+        OPEN_FILES.use(self, key)
+        if key in self._files:
+            return self._files[key]
+
+        directory = os.path.join(self.root, sub_path)
+        os.makedirs(directory, exist_ok=True)
+        filepath = os.path.join(directory, f'{name}.csv')
+
+        if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
+            with open(filepath, 'r') as file:
+                columns = file.readline().strip().split(',')
+            file = open(filepath, 'a', newline='')
+        else:
+            columns = list(columns)
+            file = open(filepath, 'w', newline='')
+            file.write(','.join(columns) + '\n')
+            self._created.add(directory)
+
+        logger.debug(f'Opened {filepath} for appending.')
+        self._files[key] = (file, columns)
+        return self._files[key]
+
+
+class PartitionedStore(BufferedWriter):
+    """
+    Columnar storage partitioned by day: `<sub_path>/<name>/YYYY-MM-DD.parquet` (or `.feather`).
+    Each flush writes its rows as small `YYYY-MM-DD.<n>.parquet` segments next to their partition;
+    `compact_interval` seconds after a flush the segments are merged into the day's file. Reads only
+    open the partitions overlapping the requested time range.
+    """
+    FORMATS = {'parquet': (pd.read_parquet, lambda frame, path: frame.to_parquet(path, index=False)),
+               'feather': (pd.read_feather, lambda frame, path: frame.reset_index(drop=True).to_feather(path))}
+
+    def __init__(self, root: str, flush_rows: int = 100, flush_interval: float = 5.0,
+                 file_format: str = 'parquet', compact_interval: float = 600):
+        if file_format not in self.FORMATS:
+            raise ValueError(f'Unknown storage format "{file_format}", expected one of {list(self.FORMATS)}')
+        self.extension = f'.{file_format}'
+        self.read_file, self.write_file = self.FORMATS[file_format]
+        self.compact_interval = compact_interval
+        self._sequence = count(int(datetime.now().timestamp() * 1000))
+        self._files_lock = threading.Lock()
+        self._unsynced = set()  # segments written since the last sync
+        super().__init__(root, flush_rows, flush_interval)
+
+    def things(self) -> list:
+        if not os.path.isdir(self.root):
+            return []
+
+        return [(category, name)
+                for category in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, category))
+                for name in os.listdir(os.path.join(self.root, category))
+                if os.path.isdir(os.path.join(self.root, category, name))]
+
+    def partitions(self, sub_path: str, name: str) -> dict:
+        directory = os.path.join(self.root, sub_path, name)
+        if not os.path.isdir(directory):
+            return {}
+
+        partitions = {}  # day -> [paths]
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(self.extension):
+                day = filename.split('.', 1)[0]
+                partitions.setdefault(day, []).append(os.path.join(directory, filename))
+        return partitions
+
+    def read(self, sub_path: str, name: str, start: datetime = None, end: datetime = None) -> pd.DataFrame:
+        first = start.strftime('%Y-%m-%d') if start is not None else ''
+        last = end.strftime('%Y-%m-%d') if end is not None else '9999'
+
+        with self._files_lock:
+            frames = [self.read_file(path)
+                      for day, paths in sorted(self.partitions(sub_path, name).items()) if first <= day <= last
+                      for path in paths]
+
+        if not frames:
+            return pd.DataFrame()
+        return select(pd.concat(frames, ignore_index=True), start, end).sort_values('datetime', kind='stable')
+
+    def compact(self, force: bool = False):
+        today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+
+        for sub_path, name in self.things():
+            for day, paths in self.partitions(sub_path, name).items():
+                segments = [path for path in paths if os.path.basename(path).count('.') > 1]
+                if not segments or (day == today and not force and len(segments) < 10):
+                    continue
+
+                target = os.path.join(self.root, sub_path, name, f'{day}{self.extension}')
+                frame = pd.concat([self.read_file(path) for path in paths], ignore_index=True)
+                frame = frame.sort_values('datetime', kind='stable')
+                self.write_file(frame, f'{target}.tmp')
+                fsync_file(f'{target}.tmp')
+
+                # The merged file is durable before the segments it replaces are removed
+                with self._files_lock:
+                    os.replace(f'{target}.tmp', target)
+                    fsync_directory(os.path.dirname(target))
+                    [os.remove(path) for path in segments]
+                logger.debug(f'Compacted {len(segments)} segments into {target}')
+
+    def expire(self, sub_path: str, name: str, before: datetime, archive: str) -> int:
+        # Partitions are already compressed: whole days older than `before` are moved to the archive as they are
+        cutoff = to_timestamp(before).strftime('%Y-%m-%d')
+        directory = os.path.join(archive, sub_path, name)
+        expired = 0
+        with self._lock, self._files_lock:
+            self._flush()
+            for day, paths in self.partitions(sub_path, name).items():
+                if day >= cutoff:
+                    continue
+                os.makedirs(directory, exist_ok=True)
+                for path in paths:
+                    expired += len(self.read_file(path))
+                    os.replace(path, os.path.join(directory, os.path.basename(path)))
+
+        if expired:
+            logger.debug(f'Archived {expired} rows of {sub_path}/{name} before {cutoff}')
+        return expired
+
+    def _write(self, sub_path: str, name: str, frames: list):
+        directory = os.path.join(self.root, sub_path, name)
+        os.makedirs(directory, exist_ok=True)
+
+        frame = pd.concat(frames, ignore_index=True)
+        frame['datetime'] = to_utc(frame['datetime'])
+        for day, rows in frame.groupby(frame['datetime'].dt.strftime('%Y-%m-%d')):
+            path = os.path.join(directory, f'{day}.{next(self._sequence)}{self.extension}')
+            self.write_file(rows, f'{path}.tmp')
+            os.replace(f'{path}.tmp', path)
+            self._unsynced.add(path)
+        FLUSHER.call_later(self, 'compact', self.compact_interval, self.compact)
+
+    def _sync(self):
+        # Segments compacted meanwhile were fsynced by the compaction
+        with self._files_lock:
+            [fsync_file(path) for path in self._unsynced if os.path.exists(path)]
+            [fsync_directory(directory) for directory in {os.path.dirname(path) for path in self._unsynced}]
+            self._unsynced = set()
+
+    def _close(self):
+        self.compact()
+
+
+def archive_csv(frame: pd.DataFrame, path: str):
+    # gzip members can be concatenated: each archiving pass appends one to the month's file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    exists = os.path.exists(path)
+    with gzip.open(path, 'at', newline='') as file:
+        frame.to_csv(file, header=not exists, index=False)
+
+
+def make_storage(config: dict) -> BufferedWriter:
+    file_format = config.get('storage', 'csv')
+    if file_format == 'csv':
+        OPEN_FILES.limit = config.get('max_open_files', OPEN_FILES.limit)
+        return SegmentWriter(config['data_path'],
+                             flush_rows=config.get('flush_rows', 100),
+                             flush_interval=config.get('flush_interval', 5.0))
+
+    return PartitionedStore(config['data_path'],
+                            flush_rows=config.get('flush_rows', 100),
+                            flush_interval=config.get('flush_interval', 5.0),
+                            file_format=file_format,
+                            compact_interval=config.get('compact_interval', 600))
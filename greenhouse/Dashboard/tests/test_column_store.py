@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import pytest
+from column_store import ColumnStore
+
+START = pd.Timestamp('2024-01-01', tz='UTC')
+
+
+def rows(seconds, values, column='value') -> pd.DataFrame:
+    return pd.DataFrame({'datetime': [START + pd.Timedelta(seconds=second) for second in seconds],
+                         column: values})
+
+
+def expected(*frames) -> pd.DataFrame:
+    # Stable sort: rows with equal times stay in insertion order, as the store keeps them
+    frame = pd.concat(frames, ignore_index=True)
+    return frame.sort_values('datetime', kind='stable', ignore_index=True)
+
+
+def test_in_order_rows_are_appended():
+    store = ColumnStore()
+    store.append(rows([0, 1], [0.0, 1.0]))
+    store.append(rows([2, 3], [2.0, 3.0]))
+    assert store.frame()['value'].tolist() == [0.0, 1.0, 2.0, 3.0]
+
+
+def test_late_rows_are_merged_into_the_tail():
+    store = ColumnStore()
+    store.append(rows([0, 10, 20, 30], [0.0, 10.0, 20.0, 30.0]))
+    store.append(rows([15, 25], [15.0, 25.0]))
+
+    frame = store.frame()
+    assert frame['value'].tolist() == [0.0, 10.0, 15.0, 20.0, 25.0, 30.0]
+    assert (frame['datetime'] - START).dt.total_seconds().tolist() == [0, 10, 15, 20, 25, 30]
+
+
+def test_late_row_with_a_known_time_goes_after_the_stored_one():
+    store = ColumnStore()
+    store.append(rows([0, 10, 20], ['a', 'b', 'c']))
+    store.append(rows([10], ['late']))
+    assert store.frame()['value'].tolist() == ['a', 'b', 'late', 'c']
+
+
+def test_late_rows_older_than_everything():
+    store = ColumnStore()
+    store.append(rows([10, 20], [10.0, 20.0]))
+    store.append(rows([1, 2], [1.0, 2.0]))
+    assert store.frame()['value'].tolist() == [1.0, 2.0, 10.0, 20.0]
+
+
+def test_unsorted_batch_mixing_late_and_new_rows():
+    store = ColumnStore()
+    store.append(rows([0, 10, 20], [0.0, 10.0, 20.0]))
+    store.append(rows([30, 5, 25, 15], [30.0, 5.0, 25.0, 15.0]))
+    assert store.frame()['value'].tolist() == [0.0, 5.0, 10.0, 15.0, 20.0, 25.0, 30.0]
+
+
+def test_late_rows_merged_while_the_arrays_grow():
+    store = ColumnStore(capacity=4)
+    store.append(rows([0, 10, 20], [0.0, 10.0, 20.0]))
+    store.append(rows([5, 15, 25], [5.0, 15.0, 25.0]))
+    assert store.frame()['value'].tolist() == [0.0, 5.0, 10.0, 15.0, 20.0, 25.0]
+
+
+def test_late_rows_fill_missing_columns():
+    store = ColumnStore()
+    store.append(rows([0, 10], [0.0, 10.0]))
+    store.append(rows([5], ['on'], column='state'))
+
+    frame = store.frame()
+    assert frame['value'].tolist()[::2] == [0.0, 10.0]
+    assert pd.isna(frame['value'][1])
+    assert frame['state'].tolist()[1] == 'on'
+    assert pd.isna(frame['state'][0]) and pd.isna(frame['state'][2])
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_random_batches_match_a_sorted_concat(seed):
+    random = np.random.default_rng(seed)
+    store = ColumnStore(capacity=8)
+    frames = []
+    for batch in range(20):
+        seconds = random.integers(0, 200, size=random.integers(1, 10)).tolist()
+        frame = rows(seconds, [float(batch * 100 + index) for index in range(len(seconds))])
+        frames.append(frame)
+        store.append(frame)
+
+    pd.testing.assert_frame_equal(store.frame(), expected(*frames), check_dtype=False)
+    ranged = store.range(START + pd.Timedelta(seconds=50), START + pd.Timedelta(seconds=150))
+    assert ranged['datetime'].between(START + pd.Timedelta(seconds=50), START + pd.Timedelta(seconds=149)).all()
+    assert len(ranged) == sum(((frame['datetime'] - START).dt.total_seconds().between(50, 149)).sum()
+                              for frame in frames)
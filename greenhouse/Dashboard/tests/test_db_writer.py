@@ -0,0 +1,106 @@
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import text
+import db_writer
+from db_writer import BatchWriter, make_engine
+
+START = pd.Timestamp('2024-01-01', tz='UTC')
+
+
+def rows(seconds, value: float = 23.45) -> pd.DataFrame:
+    return pd.DataFrame({'datetime': [START + pd.Timedelta(seconds=second) for second in seconds],
+                         'value': np.full(len(seconds), value, dtype=np.float32)})
+
+
+@pytest.fixture
+def writer(tmp_path):
+    # The SQLite stand-in for the PostgreSQL database
+    writer = BatchWriter(make_engine({'url': f'sqlite:///{tmp_path / "db.sqlite"}'}), batch_rows=100,
+                         flush_interval=60, retries=2, retry_delay=0.01)
+    yield writer
+    if writer._flusher.is_alive():
+        writer.close()
+
+
+def stored(writer: BatchWriter, table: str = 'temp_in') -> list:
+    with writer.engine.connect() as conn:
+        return conn.execute(text(f'SELECT value FROM "{table}" ORDER BY datetime')).scalars().all()
+
+
+def test_rows_are_written_in_one_batch(writer):
+    writer.add('data', 'temp_in', rows([0, 1]))
+    writer.add('data', 'temp_in', rows([2]))
+    writer.flush()
+
+    # float32 is widened to its shortest decimal form
+    assert stored(writer) == [23.45, 23.45, 23.45]
+    assert writer.stats()['rows'] == 3
+    assert writer.stats()['flushes'] == 1
+
+
+def test_full_batch_wakes_the_flusher(writer):
+    writer.add('data', 'temp_in', rows(range(100)))
+    for _ in range(50):
+        if writer.stats()['rows']:
+            break
+        writer._stop.wait(0.1)
+    assert writer.stats()['rows'] == 100
+
+
+def test_rows_with_a_taken_key_are_skipped(writer):
+    writer.add('data', 'temp_in', rows([0, 1]), key=('datetime',))
+    writer.flush()
+    writer.add('data', 'temp_in', rows([1, 2]), key=('datetime',))
+    writer.flush()
+
+    assert len(stored(writer)) == 3
+
+
+def test_driver_errors_are_retried(writer, monkeypatch):
+    # COPY runs on the raw driver cursor: its errors are not wrapped by SQLAlchemy
+    failures = []
+    insert_ignore = db_writer.insert_ignore
+
+    def failing(table, conn, keys, data_iter):
+        if len(failures) < 3:
+            failures.append(1)
+            raise sqlite3.OperationalError('database is locked')
+        return insert_ignore(table, conn, keys, data_iter)
+
+    monkeypatch.setattr(db_writer, 'insert_ignore', failing)
+    writer.add('data', 'temp_in', rows([0, 1]), key=('datetime',))
+    writer.flush()
+    # Retries exhausted: the rows are queued again, not lost
+    assert writer.stats()['pending_rows'] == 2
+    assert stored(writer) == []
+
+    writer.flush()
+    assert len(stored(writer)) == 2
+    assert writer.stats()['pending_rows'] == 0
+
+
+def test_flusher_survives_unexpected_errors(writer, monkeypatch):
+    def broken(schema, table, frame, key=None):
+        raise ValueError('cannot convert')
+
+    monkeypatch.setattr(writer, 'insert', broken)
+    writer.add('data', 'temp_in', rows(range(100)))
+    writer._flusher.join(0.5)
+    assert writer._flusher.is_alive()
+    assert writer.stats()['pending_rows'] == 0
+
+    monkeypatch.undo()
+    writer.add('data', 'temp_in', rows([200]))
+    writer.flush()
+    assert stored(writer) == [23.45]
+
+
+def test_rows_past_the_limit_are_dropped(writer):
+    writer.max_pending_rows = 3
+    writer.add('data', 'temp_in', rows([0, 1]))
+    writer.add('data', 'temp_in', rows([2, 3]))
+    writer.flush()
+
+    assert len(stored(writer)) == 2
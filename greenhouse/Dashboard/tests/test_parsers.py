@@ -0,0 +1,15 @@
+import pandas as pd
+from parsers import ControllersParser
+
+START = pd.Timestamp('2024-01-01', tz='UTC')
+
+
+def test_malformed_element_is_dropped_alone():
+    parser = ControllersParser()
+    categories = [{'heater': {'enabled': True, 'busy': False}, 'fan': {'enabled': True}},
+                  {'heater': {'enabled': False, 'busy': True}, 'fan': None}]
+    parsed = parser.parse_batch(categories, [START, START + pd.Timedelta(seconds=1)])
+
+    assert list(parsed) == ['heater']
+    assert parsed['heater']['enabled'].tolist() == [True, False]
+    assert parsed['heater']['busy'].tolist() == [False, True]
@@ -0,0 +1,35 @@
+import json
+from datetime import datetime, timezone
+import pytest
+from payload import decode, PayloadError
+
+CATEGORIES = {'sensors': {'temp_in': 21.5}, 'actuators': {}, 'controllers': {}}
+
+
+def message(**fields) -> str:
+    return json.dumps(dict(CATEGORIES, **fields))
+
+
+def test_accepts_datetime_and_timestamp():
+    by_datetime = decode(message(datetime='2024-01-02_03-04-05'))
+    by_timestamp = decode(message(timestamp=1704164645, device='board-1'))
+
+    assert by_datetime['datetime'] == by_timestamp['datetime'] == datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+    assert by_datetime['device'] == 'default'
+    assert by_timestamp['device'] == 'board-1'
+    assert by_datetime['sensors'] == {'temp_in': 21.5}
+
+
+@pytest.mark.parametrize('payload', [
+    message(datetime='2024-01-02_03-04-05', bogus=1),
+    message(datetime='2024-01-02_03-04-05', timestamp=1704164645, bogus=1),
+    message(timestamp=1704164645, device=['board-1']),
+    message(datetime=20240102),
+    json.dumps({'datetime': '2024-01-02_03-04-05', 'sensors': {}}),
+    message(),
+    '[]',
+    '{',
+])
+def test_rejects_invalid_payloads(payload):
+    with pytest.raises(PayloadError):
+        decode(payload)
@@ -0,0 +1,120 @@
+import threading
+import pytest
+from pipeline import BoundedQueue, IngestPipeline
+
+
+def put_in_thread(queue: BoundedQueue, key, item) -> threading.Thread:
+    thread = threading.Thread(target=queue.put, args=(key, item), daemon=True)
+    thread.start()
+    thread.join(0.2)
+    return thread
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        BoundedQueue(policy='unbounded')
+
+
+def test_block_waits_for_a_free_slot():
+    queue = BoundedQueue(2, 'block')
+    queue.put('a', 1)
+    queue.put('a', 2)
+
+    thread = put_in_thread(queue, 'a', 3)
+    assert thread.is_alive()
+    assert queue.get() == ('a', [1])
+    thread.join(1)
+    assert not thread.is_alive()
+    assert queue.get_many(10) == [('a', [2]), ('a', [3])]
+    assert queue.dropped == 0
+
+
+def test_drop_oldest_evicts_the_first_entries():
+    queue = BoundedQueue(2, 'drop_oldest')
+    [queue.put('a', item) for item in range(5)]
+
+    assert queue.get_many(10) == [('a', [3]), ('a', [4])]
+    assert queue.dropped == 3
+    assert queue.puts == 5
+
+
+def test_coalesce_batches_items_of_a_queued_key():
+    queue = BoundedQueue(2, 'coalesce', max_coalesced=3)
+    queue.put('a', 1)
+    queue.put('b', 2)
+    queue.put('a', 3)
+    queue.put('b', 4)
+    queue.put('b', 5)
+
+    assert queue.get_many(10) == [('a', [1, 3]), ('b', [2, 4, 5])]
+    assert queue.coalesced == 3
+    assert queue.dropped == 0
+
+
+def test_coalesce_blocks_once_the_entry_is_full():
+    queue = BoundedQueue(1, 'coalesce', max_coalesced=2)
+    queue.put('a', 1)
+    queue.put('a', 2)
+
+    thread = put_in_thread(queue, 'a', 3)
+    assert thread.is_alive()
+    assert queue.get() == ('a', [1, 2])
+    thread.join(1)
+    assert queue.get() == ('a', [3])
+
+
+def test_coalesce_blocks_for_a_key_with_nothing_queued():
+    queue = BoundedQueue(1, 'coalesce')
+    queue.put('a', 1)
+
+    thread = put_in_thread(queue, 'b', 2)
+    assert thread.is_alive()
+    assert queue.get() == ('a', [1])
+    thread.join(1)
+    assert queue.get() == ('b', [2])
+
+
+def test_join_waits_for_every_entry_to_be_done():
+    queue = BoundedQueue(4)
+    queue.put('a', 1)
+    queue.put('a', 2)
+    joined = threading.Thread(target=queue.join, daemon=True)
+    joined.start()
+
+    entries = queue.get_many(10)
+    joined.join(0.1)
+    assert joined.is_alive()
+    [queue.task_done() for _ in entries]
+    joined.join(1)
+    assert not joined.is_alive()
+
+
+def test_get_times_out_when_empty():
+    assert BoundedQueue().get(timeout=0.01) is None
+
+
+def test_pipeline_runs_every_item_through_the_stages():
+    stored = []
+    pipeline = IngestPipeline([('double', lambda item: item * 2),
+                               ('sum', sum, True),
+                               ('store', stored.append)],
+                              maxsize=2, policy='coalesce', batch_size=3)
+    [pipeline.put('key', item) for item in range(10)]
+    pipeline.close()
+
+    assert sum(stored) == sum(item * 2 for item in range(10))
+    assert pipeline.metrics()['double']['processed'] == 10
+
+
+def test_counters_add_up_across_workers():
+    def check(item):
+        if item % 10 == 0:
+            raise ValueError(item)
+        return item
+
+    pipeline = IngestPipeline([('check', check)], maxsize=100, workers=8)
+    [pipeline.put(item, item) for item in range(2000)]
+    pipeline.close()
+
+    assert pipeline.metrics()['check']['processed'] == 1800
+    assert pipeline.metrics()['check']['errors'] == 200
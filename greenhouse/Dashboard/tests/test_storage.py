@@ -0,0 +1,62 @@
+import pandas as pd
+import pytest
+import storage
+from storage import SegmentWriter
+
+START = pd.Timestamp('2024-01-01', tz='UTC')
+
+
+def rows(second: int) -> pd.DataFrame:
+    return pd.DataFrame({'datetime': [START + pd.Timedelta(seconds=second)], 'value': [float(second)]})
+
+
+@pytest.fixture
+def open_files(monkeypatch):
+    files = storage.OpenFiles(limit=3)
+    monkeypatch.setattr(storage, 'OPEN_FILES', files)
+    return files
+
+
+def test_open_files_are_capped_across_writers(tmp_path, open_files):
+    writers = [SegmentWriter(str(tmp_path / str(index)), flush_rows=1000) for index in range(2)]
+    for second in range(3):
+        for writer in writers:
+            for name in ('a', 'b', 'c'):
+                writer.append('sensors', name, rows(second))
+            writer.flush()
+            assert sum(len(writer._files) for writer in writers) <= open_files.limit
+
+    for writer in writers:
+        writer.close()
+        for name in ('a', 'b', 'c'):
+            assert writer.read('sensors', name)['value'].tolist() == [0.0, 1.0, 2.0]
+
+
+def test_flush_closes_idle_files(tmp_path, open_files):
+    writer = SegmentWriter(str(tmp_path), flush_rows=1000)
+    writer.append('sensors', 'a', rows(0))
+    writer.append('sensors', 'b', rows(0))
+    writer.flush()
+    writer.append('sensors', 'a', rows(1))
+    writer.flush()
+
+    assert list(writer._files) == [('sensors', 'a')]
+    writer.sync()
+    writer.close()
+    assert writer.read('sensors', 'b')['value'].tolist() == [0.0]
+
+
+@pytest.mark.parametrize('scanned', [False, True])
+def test_expire_finds_late_rows(tmp_path, open_files, scanned):
+    writer = SegmentWriter(str(tmp_path / 'data'), flush_rows=1000)
+    for second in (100, 101):
+        writer.append('sensors', 'a', rows(second))
+    if scanned:
+        # The oldest time is known before the late row arrives
+        assert writer.expire('sensors', 'a', START, str(tmp_path / 'archive')) == 0
+    writer.append('sensors', 'a', rows(10))
+
+    assert writer.expire('sensors', 'a', START + pd.Timedelta(seconds=50), str(tmp_path / 'archive')) == 1
+    assert writer.expire('sensors', 'a', START + pd.Timedelta(seconds=50), str(tmp_path / 'archive')) == 0
+    writer.close()
+    assert writer.read('sensors', 'a')['value'].tolist() == [100.0, 101.0]
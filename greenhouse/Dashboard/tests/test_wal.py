@@ -0,0 +1,111 @@
+import os
+import pandas as pd
+import pytest
+from wal import WriteAheadLog, encode, decode
+
+START = pd.Timestamp('2024-01-01', tz='UTC')
+
+
+def record(second: int, value: float) -> dict:
+    return {'sensors': {'temp_in': pd.DataFrame({'datetime': [START + pd.Timedelta(seconds=second)],
+                                                 'value': [value]})}}
+
+
+def values(records: list) -> list:
+    return [value for parsed in records for value in parsed['sensors']['temp_in']['value']]
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    return str(tmp_path / 'wal')
+
+
+def write(path: str, count: int, start: int = 0) -> WriteAheadLog:
+    wal = WriteAheadLog(path)
+    [wal.append(record(second, float(second))) for second in range(start, start + count)]
+    wal.close()
+    return wal
+
+
+def test_replay_returns_every_record(log_path):
+    write(log_path, 3)
+
+    records = list(WriteAheadLog(log_path).replay())
+    assert values(records) == [0.0, 1.0, 2.0]
+    assert records[1]['sensors']['temp_in']['datetime'].tolist() == [START + pd.Timedelta(seconds=1)]
+
+
+def last_record_offset(segment: str) -> int:
+    with open(segment, 'rb') as file:
+        offset = 0
+        while True:
+            header = file.read(WriteAheadLog.HEADER.size)
+            if not header:
+                return offset
+            length, _ = WriteAheadLog.HEADER.unpack(header)
+            last, offset = offset, file.seek(length, os.SEEK_CUR)
+            if offset == os.path.getsize(segment):
+                return last
+
+
+@pytest.mark.parametrize('kept', [0, 4, WriteAheadLog.HEADER.size, WriteAheadLog.HEADER.size + 1, -1])
+def test_torn_tail_is_dropped(log_path, kept):
+    # Only `kept` bytes of the last record were written: none, part of its header, its header, part of its body
+    wal = write(log_path, 3)
+    segment = wal.segments()[-1]
+    offset = last_record_offset(segment)
+    with open(segment, 'r+b') as file:
+        file.truncate(os.path.getsize(segment) - 1 if kept == -1 else offset + kept)
+
+    assert values(WriteAheadLog(log_path).replay()) == [0.0, 1.0]
+
+
+def test_corrupted_tail_is_dropped(log_path):
+    wal = write(log_path, 3)
+    segment = wal.segments()[-1]
+    with open(segment, 'r+b') as file:
+        file.seek(-1, os.SEEK_END)
+        byte = file.read(1)
+        file.seek(-1, os.SEEK_END)
+        file.write(bytes([byte[0] ^ 0xFF]))
+
+    assert values(WriteAheadLog(log_path).replay()) == [0.0, 1.0]
+
+
+def test_earlier_segments_survive_a_torn_last_segment(log_path):
+    wal = WriteAheadLog(log_path)
+    [wal.append(record(second, float(second))) for second in range(2)]
+    wal.rotate()
+    [wal.append(record(second, float(second))) for second in range(2, 4)]
+    wal.close()
+    first, last = wal.segments()
+    with open(last, 'r+b') as file:
+        file.truncate(os.path.getsize(last) - 1)
+
+    assert values(WriteAheadLog(log_path).replay()) == [0.0, 1.0, 2.0]
+
+
+def test_appends_after_recovery_go_to_a_new_segment(log_path):
+    wal = write(log_path, 2)
+    torn = wal.segments()[-1]
+    with open(torn, 'r+b') as file:
+        file.truncate(os.path.getsize(torn) - 1)
+
+    recovered = WriteAheadLog(log_path)
+    assert values(recovered.replay()) == [0.0]
+    recovered.append(record(10, 10.0))
+    recovered.close()
+    assert len(recovered.segments()) == 2
+
+    # The torn record stays ignored, the new one is replayed after it
+    assert values(WriteAheadLog(log_path).replay()) == [0.0, 10.0]
+
+
+@pytest.mark.parametrize('unit', ['ns', 'us'])
+def test_encode_keeps_times_and_shortest_floats(unit):
+    times = pd.Series([START, START + pd.Timedelta(microseconds=1500)]).dt.as_unit(unit)
+    frame = pd.DataFrame({'datetime': times, 'value': pd.Series([23.45, 0.1], dtype='float32')})
+    decoded = decode(encode({'sensors': {'temp_in': frame}}))['sensors']['temp_in']
+
+    assert decoded['datetime'].tolist() == times.tolist()
+    assert decoded['value'].tolist() == [23.45, 0.1]
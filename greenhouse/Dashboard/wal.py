@@ -0,0 +1,163 @@
+import marshal
+import os
+import struct
+import threading
+import zlib
+import numpy as np
+import pandas as pd
+from loguru import logger
+from column_store import epoch_ns
+from scheduler import Scheduler
+
+# Shared by the logs of every shard: fsyncs are short, checkpoints flush storage and run on their own thread
+SYNCER = Scheduler('wal-sync')
+CHECKPOINTER = Scheduler('wal-checkpoint')
+
+
+def encode(parsed: dict) -> bytes:
+    # {category: {element: DataFrame}} -> marshal of plain lists, datetimes as epoch ns, float32 widened
+    return marshal.dumps({category: {element: {column: column_list(series) for column, series in frame.items()}
+                                     for element, frame in elements.items()}
+                          for category, elements in parsed.items()})
+
+
+def column_list(series: pd.Series) -> list:
+    # Parsed columns are already typed, so each is read straight from its array: no DataFrame is built
+    dtype = series.dtype
+    if getattr(dtype, 'tz', None) is not None:
+        # Aware datetimes are stored as UTC epochs in their own unit (ns, or us with pandas 3)
+        return series.array.as_unit('ns').asi8.tolist()
+    if dtype.kind == 'M':
+        return epoch_ns(series).tolist()
+    if dtype == np.float32:
+        # Shortest decimal form of each value, as `widen`
+        return series.to_numpy().astype(str).astype(np.float64).tolist()
+    return series.tolist()
+
+
+def decode(body: bytes) -> dict:
+    parsed = marshal.loads(body)
+    for elements in parsed.values():
+        for element, columns in elements.items():
+            frame = pd.DataFrame(columns)
+            frame['datetime'] = pd.to_datetime(frame['datetime'], unit='ns', utc=True)
+            elements[element] = frame
+    return parsed
+
+
+class WriteAheadLog:
+    """
+    Binary log of the rows accepted by the backend, kept in numbered `<path>/<n>.wal` segments. A record is
+    an 8 bytes header (body length, CRC32) followed by the marshal-encoded rows: appending a message costs
+    about 40 µs per element, mostly pandas column access, and no fsync. The file is fsynced in groups, `sync_interval` seconds after the first
+    unsynced record or once `sync_records` are waiting, so a crash loses at most the last `sync_interval`
+    seconds of rows. The syncs of all logs run on the shared SYNCER thread, which sleeps while nothing
+    is appended.
+
+    `checkpoint_interval` seconds after the first record since the last checkpoint, `on_checkpoint` is
+    called on the CHECKPOINTER thread: it is expected to `rotate` the log,
+    flush the storage and `remove` the segments returned by `rotate`. The segments left at startup are
+    what storage had not flushed yet and are `replay`ed; a torn record at the end of a segment is dropped.
+    """
+    HEADER = struct.Struct('<II')
+
+    def __init__(self, path: str, sync_interval: float = 0.05, sync_records: int = 1000,
+                 checkpoint_interval: float = 60, on_checkpoint=None):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.sync_records = sync_records
+        self.checkpoint_interval = checkpoint_interval
+        self.on_checkpoint = on_checkpoint
+        os.makedirs(path, exist_ok=True)
+        self._recovered = self.segments()
+        self._sequence = int(os.path.basename(self._recovered[-1])[:-len('.wal')]) + 1 if self._recovered else 0
+        self._lock = threading.Lock()
+        self._file = self._open()
+        self._unsynced = 0
+        self._checkpoint_scheduled = False
+        self._closed = False
+
+    def segments(self) -> list:
+        names = [name for name in os.listdir(self.path) if name.endswith('.wal')]
+        return [os.path.join(self.path, name) for name in sorted(names, key=lambda name: int(name[:-len('.wal')]))]
+
+    def append(self, parsed: dict):
+        body = encode(parsed)
+        with self._lock:
+            self._file.write(self.HEADER.pack(len(body), zlib.crc32(body)))
+            self._file.write(body)
+            self._unsynced += 1
+            unsynced = self._unsynced
+            checkpoint = self.on_checkpoint is not None and not self._checkpoint_scheduled
+            self._checkpoint_scheduled = self._checkpoint_scheduled or checkpoint
+
+        if unsynced == 1:
+            SYNCER.call_later(self, 'sync', self.sync_interval, self.sync)
+        elif unsynced >= self.sync_records:
+            SYNCER.call_later(self, 'sync', 0, self.sync)
+        if checkpoint:
+            CHECKPOINTER.call_later(self, 'checkpoint', self.checkpoint_interval, self._checkpoint)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def sync(self):
+        with self._lock:
+            if self._closed or not self._unsynced:
+                return
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def rotate(self) -> list:
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._unsynced = 0
+            old = self.segments()
+            self._file = self._open()
+        return old
+
+    @staticmethod
+    def remove(segments: list):
+        [os.remove(segment) for segment in segments]
+
+    def replay(self):
+        for segment in self._recovered:
+            records = 0
+            with open(segment, 'rb') as file:
+                while True:
+                    header = file.read(self.HEADER.size)
+                    if len(header) < self.HEADER.size:
+                        break
+                    length, checksum = self.HEADER.unpack(header)
+                    body = file.read(length)
+                    if len(body) < length or zlib.crc32(body) != checksum:
+                        logger.warning(f'Dropping torn record at the end of {segment}')
+                        break
+                    records += 1
+                    yield decode(body)
+            logger.info(f'Replayed {records} records from {segment}')
+
+    def close(self):
+        SYNCER.cancel(self)
+        CHECKPOINTER.cancel(self)
+        with self._lock:
+            self._closed = True
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+    def _open(self):
+        path = os.path.join(self.path, f'{self._sequence}.wal')
+        self._sequence += 1
+        return open(path, 'ab')
+
+    def _checkpoint(self):
+        with self._lock:
+            self._checkpoint_scheduled = False
+            if self._closed:
+                return
+        self.on_checkpoint()
@@ -0,0 +1,172 @@
+import hashlib
+import multiprocessing
+import queue
+import signal
+from bisect import bisect
+from time import perf_counter
+from loguru import logger
+from observer_pattern import Observer
+
+# Counters each worker publishes in the pool's shared memory
+STATS = ('payloads', 'batches', 'errors', 'store_seconds', 'shards')
+
+
+class HashRing:
+    """
+    Consistent hashing of device ids over `nodes` workers: each worker owns `replicas` points of the ring
+    and a device belongs to the worker of the first point after its hash.
+    """
+
+    def __init__(self, nodes: int, replicas: int = 64):
+        points = sorted((self.hash(f'{node}:{replica}'), node) for node in range(nodes) for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    @staticmethod
+    def hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def node(self, key: str) -> int:
+        return self._nodes[bisect(self._hashes, self.hash(key)) % len(self._nodes)]
+
+
+def worker_main(index: int, workers: int, config_path: str, inbox, results, stats, initializer=None):
+    from backend import Backend
+
+    # Ctrl-C reaches the whole process group: the parent stops the workers in order through their inbox
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ring = HashRing(workers)
+    backend = Backend(config_path, subscribe=False, owns=lambda device: ring.node(device) == index)
+    if initializer is not None:
+        initializer(backend)
+
+    metrics = {'payloads': 0, 'batches': 0, 'errors': 0, 'store_seconds': 0.0, 'shards': len(backend.shards)}
+    offset = index * len(STATS)
+    stats[offset:offset + len(STATS)] = [metrics[stat] for stat in STATS]
+    while True:
+        kind, data = inbox.get()
+        if kind == 'batch':
+            start = perf_counter()
+            try:
+                backend.store(backend.parse_batch(data))
+            except Exception as e:
+                # A bad batch must not end the worker: the parent would block on its full inbox
+                metrics['errors'] += 1
+                logger.exception(f'Worker {index} failed to store {len(data)} payloads: {e}')
+            metrics['store_seconds'] += perf_counter() - start
+            metrics['payloads'] += len(data)
+            metrics['batches'] += 1
+            metrics['shards'] = len(backend.shards)
+            stats[offset:offset + len(STATS)] = [metrics[stat] for stat in STATS]
+        elif kind == 'stop':
+            break
+
+    backend.close()
+    results.put((index, dict(metrics, shards=len(backend.shards))))
+
+
+class WorkerPool(Observer):
+    """
+    Runs `workers` processes, each with its own Backend owning the devices that the HashRing assigns to
+    it. `route` sends decoded payloads to their owner over a pipe-backed queue, one message per batch.
+    `initializer(backend)` runs in every worker after its Backend is ready, e.g. to attach observers.
+    Workers publish their counters in shared memory after every batch, so `metrics` never waits on them.
+    A worker found dead when a batch is sent to it is restarted with a new inbox (the batches left in the
+    old one are lost); one that does not take a batch for `put_timeout` seconds is reported.
+    """
+
+    def __init__(self, config_path: str, workers: int, queue_size: int = 1000, initializer=None,
+                 put_timeout: float = 5):
+        self.ring = HashRing(workers)
+        self.config_path = config_path
+        self.initializer = initializer
+        self.put_timeout = put_timeout
+        self.queue_size = queue_size
+        self.restarts = 0
+        self._context = multiprocessing.get_context('spawn')
+        self.inboxes = [self._context.Queue(queue_size) for _ in range(workers)]
+        self.results = self._context.Queue()
+        self.stats = self._context.Array('d', len(STATS) * workers)
+        self.processes = [self._start(index) for index in range(workers)]
+        logger.info(f'Started {workers} ingest workers.')
+
+    def _start(self, index: int):
+        process = self._context.Process(target=worker_main, name=f'ingest-worker-{index}', daemon=True,
+                                        args=(index, len(self.inboxes), self.config_path, self.inboxes[index],
+                                              self.results, self.stats, self.initializer))
+        process.start()
+        return process
+
+    def update(self, payload):
+        if payload is not None:
+            self.route([payload])
+
+    def route(self, payloads: list):
+        batches = {}
+        for payload in payloads:
+            batches.setdefault(self.ring.node(payload['device']), []).append(payload)
+
+        for index, batch in batches.items():
+            self._put(index, ('batch', batch))
+
+    def metrics(self) -> dict:
+        values = self.stats[:]
+        reports = {index: dict(zip(STATS, values[index * len(STATS):(index + 1) * len(STATS)]))
+                   for index in range(len(self.processes))}
+        return self.totals(reports)
+
+    def close(self, timeout: float = 30) -> dict:
+        logger.info('Stopping ingest workers...')
+        for inbox, process in zip(self.inboxes, self.processes):
+            if not process.is_alive():
+                logger.error(f'{process.name} died (exit code {process.exitcode}) before the stop')
+                continue
+            try:
+                inbox.put(('stop', None), timeout=timeout)
+            except queue.Full:
+                logger.error(f'{process.name} is not taking batches (alive: {process.is_alive()})')
+        metrics = self._collect(timeout)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.error(f'{process.name} did not stop in {timeout}s, terminating it')
+                process.terminate()
+        logger.info(f'Ingest workers stopped: {metrics}')
+        return metrics
+
+    def _put(self, index: int, message: tuple):
+        # Blocks while the worker is busy, like a plain put, but never on a dead worker
+        while True:
+            process = self.processes[index]
+            if not process.is_alive():
+                self.restarts += 1
+                logger.error(f'{process.name} died (exit code {process.exitcode}), restarting it')
+                # A process killed while waiting in get() holds the old inbox's read lock forever
+                self.inboxes[index].cancel_join_thread()
+                self.inboxes[index] = self._context.Queue(self.queue_size)
+                self.processes[index] = self._start(index)
+            try:
+                self.inboxes[index].put(message, timeout=self.put_timeout)
+                return
+            except queue.Full:
+                if self.processes[index].is_alive():
+                    logger.warning(f'{self.processes[index].name} took no batch for {self.put_timeout}s')
+
+    def _collect(self, timeout: float) -> dict:
+        reports = {}
+        try:
+            while len(reports) < len(self.processes):
+                index, report = self.results.get(timeout=timeout)
+                reports[index] = report
+        except queue.Empty:
+            logger.warning(f'Missing metrics from workers {set(range(len(self.processes))) - reports.keys()}')
+        return self.totals(reports)
+
+    @staticmethod
+    def totals(reports: dict) -> dict:
+        total = {'workers': len(reports)}
+        for report in reports.values():
+            for key, value in report.items():
+                total[key] = total.get(key, 0) + value
+        total['per_worker'] = reports
+        return total